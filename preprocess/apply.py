@@ -1,6 +1,15 @@
 import os
+import sys
+import json
+import time
+import difflib
+import hashlib
+import tempfile
+from argparse import ArgumentParser
 
-from augment import augment
+from preprocess.augment import augment, count_skipped_stages
+from preprocess.cache import augmentation_key
+from preprocess.generate.executor import AugmentationExecutor, add_executor_arguments
 
 from preprocess.transform.add_new_lines import AddNewLineTransformer
 from preprocess.transform.add_remove_commas import CommaTransformer
@@ -15,10 +24,11 @@ from preprocess.transform.remove_empty_lines import RemoveEmptyLineTransformer
 from preprocess.transform.remove_unused_imports import RemoveUnusedImportTransformer
 from preprocess.transform.utils.tools import get_unused_imports, transform, get_name_generator
 
+STATE_FILE = '.augment_state.json'
 
-def apply(path, preserved_names):
-    temp = 1
-    args_list = [
+
+def get_args_list(preserved_names, temp=1):
+    return [
         # (AddNewLineTransformer, (0.5 * temp,)),
         # (CommaTransformer, (True, temp)),
         # (CommaTransformer, (False, temp)),
@@ -35,24 +45,232 @@ def apply(path, preserved_names):
         # (RemoveEmptyLineTransformer, (0.5 * temp,)),
     ]
 
-    for name in os.listdir(path):
-        new_path = os.path.join(path, name)
 
-        if os.path.isdir(new_path):
-            apply(new_path, preserved_names)
-        elif os.path.isfile(new_path) and len(name) > 2 and name[-3:] == '.py':
+def find_python_files(path):
+    """
+    Paths of the .py files under path in a sorted order, found with os.scandir without following symbolic links
+    """
+    files = []
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in reversed(entries):
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.is_file(follow_symlinks=False) and entry.name.endswith('.py'):
+                files.append(entry.path)
+    return sorted(files)
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def write_atomic(path, text):
+    """
+    Write to a temporary file in the same directory and rename it to path, keeping the permissions of path
+    """
+    mode = os.stat(path).st_mode if os.path.exists(path) else None
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', prefix='.' + os.path.basename(path), suffix='.tmp'
+    )
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            f.write(text)
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def rewrite_file(path, rel_path, args_list, preserved_names, seed, dry_run=False):
+    """
+    Augment a file in place
+    :param rel_path: path relative to the root directory, also used as the sample id of the augmentation
+    :param dry_run: do not write the file, return the unified diff instead
+    :return: dict of status ('changed', 'unchanged' or 'failed'), log, diff, and the mtime and hash of the file
+    """
+    result = {'path': rel_path, 'log': {}, 'diff': None}
+    try:
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            source = f.read()
+        fixed, result['log'] = augment(
+            source, list(args_list), 1, preserved_names, pipeline=True, final_parse_test=True,
+            skip_failed_stages=True, seed=seed, sample_id=rel_path
+        )
+    except Exception as e:
+        result.update(status='failed', error=f'{type(e).__name__}: {e}')
+        return result
+
+    if fixed == source:
+        result['status'] = 'unchanged'
+    else:
+        result['status'] = 'changed'
+        if dry_run:
+            result['diff'] = ''.join(difflib.unified_diff(
+                source.splitlines(keepends=True), fixed.splitlines(keepends=True),
+                fromfile=f'a/{rel_path}', tofile=f'b/{rel_path}'
+            ))
+        else:
+            write_atomic(path, fixed)
+
+    if not dry_run:
+        result['mtime_ns'] = os.stat(path).st_mtime_ns
+        result['sha256'] = content_hash(fixed)
+    return result
+
+
+class ApplyState:
+    """
+    mtime and hash of each file after it was augmented, saved in the root directory
+    A file is skipped if its mtime did not change, or if its content is still the augmented content
+    The state is discarded when the stages or the seed change.
+    """
+
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.files = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                state = json.load(f)
+            if state['config'] == config:
+                self.files = state['files']
 
-            with open(new_path, 'r') as f:
-                source = f.read()
-            print(new_path)
-            fixed, log = augment(source, args_list, 1, preserved_names)
-            print(sorted(log.items()))
-            with open(new_path, 'w') as f:
-                f.write(fixed)
-            print()
+    def is_done(self, path, rel_path):
+        entry = self.files.get(rel_path)
+        if entry is None:
+            return False
+        if os.stat(path).st_mtime_ns == entry['mtime_ns']:
+            return True
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            if content_hash(f.read()) != entry['sha256']:
+                return False
+        entry['mtime_ns'] = os.stat(path).st_mtime_ns
+        return True
+
+    def update(self, result):
+        self.files[result['path']] = {'mtime_ns': result['mtime_ns'], 'sha256': result['sha256']}
+
+    def save(self):
+        write_atomic(self.path, json.dumps({'config': self.config, 'files': self.files}))
+
+
+def apply_directory(
+        path, preserved_names, args_list=None, seed=0, executor=None, dry_run=False, force=False,
+        diff_path=None, report_path=None, use_state=True, save_every=100
+):
+    """
+    Augment all .py files under path in place with a process pool
+    :param args_list: stages of the augmentation (default: get_args_list(preserved_names))
+    :param executor: AugmentationExecutor (default: one process per CPU)
+    :param dry_run: do not modify the files, write a unified diff of the changes to diff_path (or stdout)
+    :param force: augment the files again even if they were augmented with the same stages and seed
+    :param report_path: json file of the summary
+    :param use_state: skip the files that were already augmented and save the state file in path
+    :param save_every: number of augmented files after which the state file is saved
+    :return: summary
+    """
+    start = time.perf_counter()
+    if args_list is None:
+        args_list = get_args_list(preserved_names)
+    config = augmentation_key('', args_list, preserved_names=preserved_names, seed=seed)
+    state = ApplyState(os.path.join(path, STATE_FILE), config) if use_state and not dry_run else None
+
+    tasks, skipped = [], []
+    for file_path in find_python_files(path):
+        rel_path = os.path.relpath(file_path, path)
+        if not force and state is not None and state.is_done(file_path, rel_path):
+            skipped.append(rel_path)
+            continue
+        tasks.append((file_path, rel_path, args_list, preserved_names, seed, dry_run))
+
+    # the state is saved as the files are rewritten, so that an interrupted run does not augment them again
+    num_updates = 0
+
+    def update_state(i, result):
+        nonlocal num_updates
+        if state is None or result['status'] == 'failed':
+            return
+        state.update(result)
+        num_updates += 1
+        if num_updates % save_every == 0:
+            state.save()
+
+    try:
+        with (executor if executor is not None else AugmentationExecutor()) as executor:
+            results = executor.starmap(rewrite_file, tasks, [os.path.getsize(task[0]) for task in tasks],
+                                       callback=update_state)
+    finally:
+        if state is not None:
+            state.save()
+
+    if dry_run:
+        diffs = ''.join(result['diff'] for result in results if result['diff'])
+        if diff_path:
+            with open(diff_path, 'w', encoding='utf-8') as f:
+                f.write(diffs)
+        else:
+            sys.stdout.write(diffs)
+
+    totals = {}
+    for result in results:
+        for key, value in result['log'].items():
+            totals[key] = totals.get(key, 0) + value
+    elapsed = time.perf_counter() - start
+    summary = {
+        'path': path,
+        'dry_run': dry_run,
+        'num_files': len(tasks) + len(skipped),
+        'changed': sum(result['status'] == 'changed' for result in results),
+        'unchanged': sum(result['status'] == 'unchanged' for result in results),
+        'skipped': len(skipped),
+        'failed': {result['path']: result['error'] for result in results if result['status'] == 'failed'},
+        'changes': dict(sorted(totals.items())),
+        'skipped_stages': count_skipped_stages(result['log'] for result in results),
+        'seconds': round(elapsed, 3),
+        'files_per_second': round(len(tasks) / max(elapsed, 1e-9), 1),
+    }
+    if report_path:
+        with open(report_path, 'w') as f:
+            f.write(json.dumps(summary, indent=1))
+        print(f'Saved: {report_path}')
+    print(f"{summary['changed']} changed, {summary['unchanged']} unchanged, {summary['skipped']} skipped, "
+          f"{len(summary['failed'])} failed in {summary['seconds']}s")
+    return summary
+
+
+def apply(path, preserved_names):
+    """
+    Augment all .py files under path in place in the current process, every time it is called
+    """
+    return apply_directory(path, preserved_names, executor=AugmentationExecutor(num_workers=0), force=True,
+                           use_state=False)
 
 
 if __name__ == "__main__":
-    base_dir = '/Users/imjeonghun/Downloads/696ds_test'
+    parser = ArgumentParser()
+    parser.add_argument('path', type=str,
+                        help='directory whose .py files are augmented in place')
+    parser.add_argument('--preserved_names', '-pn', action='append', default=['augment'],
+                        help='names that new variable names should not collide with')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, each file is augmented with a seed derived from it and its path')
+    parser.add_argument('--dry_run', '-n', action='store_true',
+                        help='do not modify the files, write the diff of the changes instead')
+    parser.add_argument('--diff', type=str, default=None,
+                        help='file of the diff in the dry-run mode (default: stdout)')
+    parser.add_argument('--force', action='store_true',
+                        help='augment files again even if they were already augmented with the same stages and seed')
+    parser.add_argument('--report', type=str, default='apply_report.json',
+                        help='json file of the summary')
+    add_executor_arguments(parser)
+    args = parser.parse_args()
 
-    apply(base_dir, {'augment'})
+    apply_directory(
+        args.path, set(args.preserved_names), seed=args.seed, executor=AugmentationExecutor.from_args(args),
+        dry_run=args.dry_run, force=args.force, diff_path=args.diff, report_path=args.report
+    )
@@ -2,8 +2,10 @@ import random
 
 import libcst as cst
 
+from preprocess.cache import augmentation_key
 from preprocess.transform.add_new_lines import AddNewLineTransformer
 from preprocess.transform.add_remove_commas import CommaTransformer
+from preprocess.transform.applicability import get_census, is_applicable, get_empty_logs, may_add_nodes
 from preprocess.transform.change_comp_to_for import ChangeCompToForTransformer
 from preprocess.transform.change_for_range_to_while import ForToWhileTransformer
 from preprocess.transform.change_lambda_to_function import LambdaToFunctionTransformer
@@ -13,7 +15,33 @@ from preprocess.transform.modify_whitespaces import ModifyWhiteSpaceTransformer
 from preprocess.transform.remove_comments import RemoveCommentsTransformer
 from preprocess.transform.remove_empty_lines import RemoveEmptyLineTransformer
 from preprocess.transform.remove_unused_imports import RemoveUnusedImportTransformer
+from preprocess.transform.utils.budget import time_limit, StageTimeout
+from preprocess.transform.utils.session import MetadataSession
 from preprocess.transform.utils.tools import get_unused_imports, transform, get_name_generator
+from preprocess.transform.utils.visit import count_nodes
+
+
+def get_default_args_list(temp=1, preserved_names=None):
+    """
+    Stages applied by augment when no args_list is given
+    """
+    return [
+        (AddNewLineTransformer, (0.5 * temp,)),
+        (CommaTransformer, (True, temp)),
+        (CommaTransformer, (False, temp)),
+        (ChangeCompToForTransformer, ("list", temp), (get_name_generator, preserved_names,)),
+        (ChangeCompToForTransformer, ("set", temp), (get_name_generator, preserved_names,)),
+        (ChangeCompToForTransformer, ("dict", temp), (get_name_generator, preserved_names,)),
+        (ChangeLocalVariableNameTransformer, (temp,), (get_name_generator, preserved_names,)),
+        (ForToWhileTransformer, (temp,), (get_name_generator, preserved_names,)),
+        (LambdaToFunctionTransformer, (temp,)),
+        (CombineStatementsTransformer, (temp, temp,)),
+        (ModifyWhiteSpaceTransformer, (True, 0.1 * temp,)),
+        (ModifyWhiteSpaceTransformer, (False, 0.1 * temp,)),
+        (RemoveCommentsTransformer, (temp,)),
+        (RemoveEmptyLineTransformer, (0.5 * temp,)),
+        (RemoveUnusedImportTransformer, (temp,), (get_unused_imports,))
+    ]
 
 
 def augment(
@@ -21,41 +49,175 @@ def augment(
         args_list=None,
         temp=1,
         preserved_names=None,
-        parse_test=True
+        parse_test=True,
+        pipeline=False,
+        final_parse_test=False,
+        stage_timeout=None,
+        max_nodes=None,
+        skip_failed_stages=False,
+        seed=None,
+        sample_id=None,
+        aug_index=0,
+        cache=None,
+        prefilter=True
 ):
-    try:
-        cst.parse_module(source)
-    except:
-        raise ValueError("Source code could not be parsed")
-
+    """
+    Apply the transformers in args_list to the source code in a random order
+    :param source: source code, or an already parsed cst.Module
+    :param args_list: list of (transformer_class, args[, get_metadata]); a default list is used if empty
+    :param temp: temperature for the default transformers
+    :param preserved_names: names that new variable names should not collide with
+    :param parse_test: check that the code of each stage can be parsed (ignored when pipeline is True)
+    :param pipeline: parse once and pass the cst.Module and its metadata from one transformer to the next
+    :param final_parse_test: check that the final code can be parsed
+    :param stage_timeout: seconds after which a stage is skipped and logged as 'skipped:<name>:timeout'
+    :param max_nodes: stages are skipped and logged as 'skipped:<name>:size' if the code has more nodes
+    :param skip_failed_stages: skip a stage that raises an error and log it as 'skipped:<name>:error'
+    :param seed: global seed; if given, the order of the stages and their random choices only depend on
+        (seed, sample_id, temp, aug_index) instead of the global random state
+    :param sample_id: id of the source code in its dataset
+    :param aug_index: index of the augmentation among the augmentations of the same sample with the same temp
+    :param cache: AugmentationCache consulted before parsing (only used when seed is given)
+    :param prefilter: skip the stages that cannot change the code according to a census of its nodes,
+        and log them with zero changes
+    :return: transformed code, log of the number of changes for each transformer
+    """
     if not args_list:
-        args_list = [
-            (AddNewLineTransformer, (0.5 * temp,)),
-            (CommaTransformer, (True, temp)),
-            (CommaTransformer, (False, temp)),
-            (ChangeCompToForTransformer, ("list", temp), (get_name_generator, preserved_names,)),
-            (ChangeCompToForTransformer, ("set", temp), (get_name_generator, preserved_names,)),
-            (ChangeCompToForTransformer, ("dict", temp), (get_name_generator, preserved_names,)),
-            (ChangeLocalVariableNameTransformer, (temp,), (get_name_generator, preserved_names,)),
-            (ForToWhileTransformer, (temp,), (get_name_generator, preserved_names,)),
-            (LambdaToFunctionTransformer, (temp,)),
-            (CombineStatementsTransformer, (temp, temp,)),
-            (ModifyWhiteSpaceTransformer, (True, 0.1 * temp,)),
-            (ModifyWhiteSpaceTransformer, (False, 0.1 * temp,)),
-            (RemoveCommentsTransformer, (temp,)),
-            (RemoveEmptyLineTransformer, (0.5 * temp,)),
-            (RemoveUnusedImportTransformer, (temp,), (get_unused_imports,))
-        ]
+        args_list = get_default_args_list(temp, preserved_names)
+
+    key = None
+    if cache is not None and seed is not None:
+        key = augmentation_key(
+            source.code if isinstance(source, cst.Module) else source, args_list,
+            temp=temp, preserved_names=preserved_names, pipeline=pipeline,
+            parse_test=parse_test, final_parse_test=final_parse_test, max_nodes=max_nodes, skip_failed_stages=skip_failed_stages, prefilter=prefilter,
+            seed=seed, sample_id=sample_id, aug_index=aug_index
+        )
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    if isinstance(source, cst.Module):
+        source_module = source
+        source = source_module.code
+    else:
+        try:
+            source_module = cst.parse_module(source)
+        except:
+            raise ValueError("Source code could not be parsed")
 
     log = {}
-    random.shuffle(args_list)
-    for args in args_list:
-        fixed, num_changes = transform(source, *args, **{'parse_test': parse_test})
+    rng = get_rng(seed, sample_id, temp, aug_index) if seed is not None else None
+    args_list = list(args_list)
+    (rng if rng is not None else random).shuffle(args_list)
+    if pipeline:
+        session = MetadataSession(source_module)
+        run_stage = session.transform
+    else:
+        fixed = source
+
+        def run_stage(*args, rng=None):
+            nonlocal fixed
+            fixed, num_changes = transform(fixed, *args, **{'parse_test': parse_test, 'rng': rng})
+            return num_changes
 
+    # each stage has its own generator, so that skipping a stage does not change the random choices of the others
+    stage_rngs = [random.Random(rng.getrandbits(64)) if rng is not None else None for _ in args_list]
+    census = get_census(source_module) if prefilter else None
+    num_nodes = count_nodes(source_module) if max_nodes else 0
+    for args, stage_rng in zip(args_list, stage_rngs):
+        name = args[0].__name__
+        if census is not None and not is_applicable(census, args):
+            log.update(get_empty_logs(args))
+            continue
+        if max_nodes and num_nodes > max_nodes:
+            log[f"skipped:{name}:size"] = log.get(f"skipped:{name}:size", 0) + 1
+            continue
+        try:
+            with time_limit(stage_timeout):
+                num_changes = run_stage(*args, rng=stage_rng)
+        except StageTimeout:
+            log[f"skipped:{name}:timeout"] = log.get(f"skipped:{name}:timeout", 0) + 1
+            if pipeline:
+                # the interrupted stage may have been resolving metadata, the next stages start from the module
+                session.invalidate()
+            continue
+        except Exception:
+            if not skip_failed_stages:
+                raise
+            log[f"skipped:{name}:error"] = log.get(f"skipped:{name}:error", 0) + 1
+            if pipeline:
+                session.invalidate()
+            continue
         log.update(num_changes)
-        source = fixed
+        if (census is not None or max_nodes) and any(num_changes.values()) and may_add_nodes(args):
+            fixed_module = session.module if pipeline else cst.parse_module(fixed)
+            if census is not None:
+                census = get_census(fixed_module)
+            if max_nodes:
+                num_nodes = count_nodes(fixed_module)
+
+    if pipeline:
+        fixed = session.module.code
 
+    if final_parse_test:
+        try:
+            cst.parse_module(fixed)
+        except:
+            raise ValueError("Augmented code could not be parsed")
+
+    # skipped stages due to timeouts depend on the machine load, so such results are not cached
+    if key is not None and not any(name.endswith(":timeout") for name in log):
+        cache.put(key, fixed, log)
     return fixed, log
 
 
+def get_rng(seed, sample_id=None, p=None, aug_index=0):
+    """
+    Random generator of one augmentation
+    Seeded with a string, which does not depend on PYTHONHASHSEED, so the same inputs give the same outputs in any
+    process
+    """
+    return random.Random(f"{seed}:{sample_id}:{p}:{aug_index}")
+
+
+def count_skipped_stages(logs):
+    """
+    Total number of skipped stages for each 'skipped:<name>:<reason>' key over the logs of several augmentations
+    """
+    counts = {}
+    for log in logs:
+        for key, value in log.items():
+            if key.startswith("skipped:"):
+                counts[key] = counts.get(key, 0) + value
+    return counts
+
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    from preprocess.cache import get_cache
+
+    source = '''import os
+def f(a):
+    b = [x * 2 for x in a]  # double
+    return b
+'''
+    cache = get_cache(os.path.join(tempfile.mkdtemp(), 'cache.db'))
 
+    # the parse tests are part of the key, so a result cached without them is not returned to a call that asked
+    # for them (here, an unparseable code stored under the key of final_parse_test=False)
+    unchecked = augment(source, [], 1, set(), final_parse_test=False, seed=0, sample_id=0, cache=cache)
+    checked = augment(source, [], 1, set(), final_parse_test=True, seed=0, sample_id=0, cache=cache)
+    assert checked == unchecked and cache.stats()['misses'] == 2
+    key = augmentation_key(
+        source, get_default_args_list(1, set()), temp=1, preserved_names=set(), pipeline=False, parse_test=True,
+        final_parse_test=False, max_nodes=None, skip_failed_stages=False, prefilter=True, seed=0, sample_id=0,
+        aug_index=0
+    )
+    cache.put(key, 'def f(:', {})
+    assert augment(source, [], 1, set(), final_parse_test=False, seed=0, sample_id=0, cache=cache)[0] == 'def f(:'
+    assert augment(source, [], 1, set(), final_parse_test=True, seed=0, sample_id=0, cache=cache) == checked
+    cache.report()
+    print(checked[0])
@@ -0,0 +1,232 @@
+"""
+Benchmark of each transformer and of the augment pipeline over the bundled corpus
+corpus.json.gz has three buckets of code from the CPython 3.11 standard library (PSF license):
+small (functions of 8-40 lines), medium (modules of 150-500 lines) and large (modules of more than 1000 lines).
+Each target runs in a fresh process, so that its peak RSS does not include the memory of the previous targets.
+The results are saved as json and can be compared with the results of another commit.
+"""
+import os
+import gzip
+import json
+import time
+import random
+import hashlib
+import platform
+import resource
+import subprocess
+import multiprocessing
+from contextlib import contextmanager
+from datetime import datetime
+from importlib.metadata import version
+from argparse import ArgumentParser
+
+import libcst as cst
+
+from preprocess.augment import augment, get_default_args_list
+from preprocess.transform.utils.tools import transform
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus.json.gz')
+BUCKETS = ('small', 'medium', 'large')
+AUGMENT_TARGETS = {
+    'augment': {},
+    'augment:pipeline': {'pipeline': True},
+}
+
+
+def load_corpus(path=CORPUS_PATH):
+    """
+    :return: dict of bucket: list of {'name': ..., 'code': ...}
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def get_stage_name(args):
+    """
+    Name of a stage of get_default_args_list, e.g., CommaTransformer(True) or ChangeCompToForTransformer('list')
+    (the temperatures are omitted)
+    """
+    options = [repr(arg) for arg in args[1] if not isinstance(arg, float)]
+    return f"{args[0].__name__}({', '.join(options)})"
+
+
+def get_targets(temp=1.0):
+    """
+    :return: dict of target name: ('stage', args) or ('augment', keyword arguments of augment)
+    """
+    targets = {get_stage_name(args): ('stage', args) for args in get_default_args_list(float(temp))}
+    targets.update({name: ('augment', kwargs) for name, kwargs in AUGMENT_TARGETS.items()})
+    return targets
+
+
+@contextmanager
+def count_parses():
+    """
+    Count the calls of cst.parse_module (all modules call it through the libcst module)
+    """
+    counts = {'parses': 0}
+    parse_module = cst.parse_module
+
+    def counted_parse_module(*args, **kwargs):
+        counts['parses'] += 1
+        return parse_module(*args, **kwargs)
+
+    cst.parse_module = counted_parse_module
+    try:
+        yield counts
+    finally:
+        cst.parse_module = parse_module
+
+
+def get_peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_target(target, samples, temp=1.0, seed=0, repeat=1):
+    """
+    Run a target over the samples of a bucket
+    A stage is applied alone with transform (parse, transform, print and parse test), and augment is applied with all
+    default stages. The random choices only depend on the seed and the index of the sample.
+    :param target: ('stage', args) or ('augment', keyword arguments of augment)
+    :param repeat: the fastest of repeat runs is reported
+    """
+    kind, params = target
+    times, errors = [], 0
+    for _ in range(repeat):
+        errors = 0
+        with count_parses() as counts:
+            start = time.perf_counter()
+            for i, sample in enumerate(samples):
+                try:
+                    if kind == 'stage':
+                        transform(sample['code'], *params, parse_test=True, rng=random.Random(f"{seed}:{i}"))
+                    else:
+                        augment(sample['code'], [], temp, None, final_parse_test=True, seed=seed, sample_id=i,
+                                **params)
+                except Exception:
+                    errors += 1
+            times.append(time.perf_counter() - start)
+
+    seconds = min(times)
+    return {
+        'samples': len(samples),
+        'lines': sum(sample['code'].count('\n') for sample in samples),
+        'errors': errors,
+        'seconds': round(seconds, 4),
+        'ms_per_sample': round(1000 * seconds / len(samples), 3),
+        'samples_per_second': round(len(samples) / seconds, 2),
+        'parses_per_sample': round(counts['parses'] / len(samples), 2),
+        'peak_rss_mb': round(get_peak_rss_mb(), 1),
+    }
+
+
+def run_isolated(func, *args):
+    """
+    Call func in a new process
+    """
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(func, args)
+
+
+def get_info(corpus_path, temp, seed, repeat):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    with open(corpus_path, 'rb') as f:
+        corpus_sha256 = hashlib.sha256(f.read()).hexdigest()
+    return {
+        'commit': commit,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'libcst': version('libcst'),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'corpus_sha256': corpus_sha256,
+        'temp': temp,
+        'seed': seed,
+        'repeat': repeat,
+    }
+
+
+def run_benchmark(targets=None, buckets=BUCKETS, corpus_path=CORPUS_PATH, temp=1.0, seed=0, repeat=1,
+                  isolated=True):
+    """
+    :param targets: names of the targets of get_targets (default: all)
+    :param isolated: run each (target, bucket) in a new process
+    :return: {'info': ..., 'results': {target: {bucket: metrics}}}
+    """
+    corpus = load_corpus(corpus_path)
+    all_targets = get_targets(temp)
+    targets = targets if targets else list(all_targets)
+    results = {}
+    for name in targets:
+        results[name] = {}
+        for bucket in buckets:
+            args = (all_targets[name], corpus[bucket], temp, seed, repeat)
+            metrics = run_isolated(run_target, *args) if isolated else run_target(*args)
+            results[name][bucket] = metrics
+            print(f"{name:45s} {bucket:6s} {metrics['ms_per_sample']:10.2f} ms/sample "
+                  f"{metrics['samples_per_second']:8.2f} samples/s {metrics['parses_per_sample']:5.1f} parses "
+                  f"{metrics['peak_rss_mb']:7.1f}MB" + (f" {metrics['errors']} errors" if metrics['errors'] else ''))
+    return {'info': get_info(corpus_path, temp, seed, repeat), 'results': results}
+
+
+def compare_results(baseline, results, threshold=1.1):
+    """
+    Print the ratio of the time per sample of each (target, bucket) to the baseline
+    :param threshold: ratios above threshold are marked as regressions
+    :return: list of (target, bucket, ratio) of the regressions
+    """
+    regressions = []
+    for name, buckets in results['results'].items():
+        for bucket, metrics in buckets.items():
+            base = baseline['results'].get(name, {}).get(bucket)
+            if base is None:
+                continue
+            ratio = metrics['ms_per_sample'] / max(base['ms_per_sample'], 1e-9)
+            regressed = ratio > threshold
+            if regressed:
+                regressions.append((name, bucket, ratio))
+            print(f"{name:45s} {bucket:6s} {base['ms_per_sample']:10.2f} -> {metrics['ms_per_sample']:10.2f} ms/sample "
+                  f"({ratio:.2f}x){' REGRESSION' if regressed else ''}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--output', '-o', type=str, default='benchmark.json',
+                        help='json file of the results')
+    parser.add_argument('--target', '-t', action='append', default=None,
+                        help='name of a target to run, e.g., augment:pipeline (default: all stages and augment modes)')
+    parser.add_argument('--bucket', '-b', action='append', default=None, choices=BUCKETS,
+                        help='bucket of the corpus to run (default: all)')
+    parser.add_argument('--corpus', type=str, default=CORPUS_PATH,
+                        help='gzipped json of {bucket: [{"name": ..., "code": ...}]}')
+    parser.add_argument('--temp', '-p', type=float, default=1.0,
+                        help='temperature of the transformers')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed')
+    parser.add_argument('--repeat', '-r', type=int, default=1,
+                        help='number of runs of each target, the fastest is reported')
+    parser.add_argument('--no_isolation', action='store_true',
+                        help='run all targets in the current process (peak RSS is then cumulative)')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='json results of another commit to compare with')
+    parser.add_argument('--threshold', type=float, default=1.1,
+                        help='ratio of the time per sample to the baseline above which a regression is reported')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.target, args.bucket or BUCKETS, args.corpus, args.temp, args.seed, args.repeat,
+                            not args.no_isolation)
+    with open(args.output, 'w') as f:
+        f.write(json.dumps(results, indent=1))
+    print(f'Saved: {args.output}')
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        compare_results(baseline, results, args.threshold)
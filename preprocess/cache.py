@@ -0,0 +1,241 @@
+"""
+On-disk cache of augmented codes
+Entries are keyed by the hash of everything that determines an augmentation (source code, transformers and their
+parameters, temperature, seed, library versions) and evicted in least recently used order when the cache is full
+"""
+import os
+import json
+import time
+import zlib
+import hashlib
+import sqlite3
+import multiprocessing.util
+from contextlib import contextmanager
+from importlib.metadata import version
+
+# increase when a transformer changes its outputs, so that the entries of the previous version are not used
+CACHE_VERSION = 3
+
+# caches opened in the current process, keyed by path
+_caches = {}
+
+
+def _describe(value):
+    """
+    json-serializable description of a stage argument that does not depend on the process
+    """
+    if isinstance(value, (set, frozenset)):
+        return sorted(_describe(v) for v in value)
+    if isinstance(value, (list, tuple)):
+        return [_describe(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _describe(v) for k, v in sorted(value.items(), key=lambda item: str(item[0]))}
+    if (isinstance(value, type) or callable(value)) and hasattr(value, '__qualname__'):
+        return f"{value.__module__}.{value.__qualname__}"
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+
+def augmentation_key(source, args_list, **params):
+    """
+    :param source: source code
+    :param args_list: list of (transformer_class, args[, get_metadata])
+    :param params: other parameters that change the augmented code (temperature, seed, ...)
+    :return: sha256 hex digest
+    """
+    description = json.dumps({
+        'version': [CACHE_VERSION, version('libcst')],
+        'stages': _describe(args_list),
+        'params': _describe(params),
+    }, sort_keys=True)
+    sha256 = hashlib.sha256(description.encode('utf-8'))
+    sha256.update(source.encode('utf-8'))
+    return sha256.hexdigest()
+
+
+def get_cache(path, max_bytes=None):
+    """
+    AugmentationCache at path, opened once in each process
+    """
+    key = (os.getpid(), os.path.abspath(path))
+    if key not in _caches:
+        _caches[key] = AugmentationCache(path, max_bytes)
+    return _caches[key]
+
+
+class AugmentationCache:
+    """
+    SQLite store of (augmented code, log) pairs with size-based LRU eviction
+    The database can be shared by several processes. A pickled cache is opened again (once) in the process that
+    unpickles it, so it can be passed to the workers of a pool.
+    Numbers of hits and misses are accumulated in the database over all processes and runs. Each process counts them
+    in memory and adds them to the database with its next put, every flush_every lookups, and when it closes the cache
+    or exits, so that lookups do not write to the database.
+    """
+
+    def __init__(self, path, max_bytes=None, access_interval=3600, flush_every=1000):
+        """
+        :param path: sqlite database file
+        :param max_bytes: total size of the compressed entries above which the least recently used ones are evicted
+        :param access_interval: seconds after which the last access time of an entry is updated by a hit
+        :param flush_every: number of lookups after which the hits and misses are added to the database
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.access_interval = access_interval
+        self.flush_every = flush_every
+        # hits and misses of this process that are not in the database yet
+        self.pending = {'hits': 0, 'misses': 0}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.connection = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.connection.execute(
+            "INSERT OR IGNORE INTO stats VALUES ('hits', 0), ('misses', 0), ('evictions', 0), ('bytes', 0)"
+        )
+        # the workers of a pool exit without closing their cache, but run the finalizers of their process
+        self._finalizer = multiprocessing.util.Finalize(self, self._close, exitpriority=10)
+
+    def __reduce__(self):
+        return get_cache, (self.path, self.max_bytes)
+
+    @contextmanager
+    def _transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def _increment(self, name, value=1):
+        self.connection.execute("UPDATE stats SET value = value + ? WHERE name = ?", (value, name))
+
+    def _count(self, name):
+        self.pending[name] += 1
+        if sum(self.pending.values()) >= self.flush_every:
+            self.flush()
+
+    def _flush_pending(self):
+        for name, value in self.pending.items():
+            if value:
+                self._increment(name, value)
+                self.pending[name] = 0
+
+    def flush(self):
+        """
+        Add the hits and misses of this process to the database
+        """
+        if any(self.pending.values()):
+            with self._transaction():
+                self._flush_pending()
+
+    def get(self, key):
+        """
+        :return: (augmented code, log), or None if key is not in the cache
+        """
+        row = self.connection.execute("SELECT value, last_access FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self._count('misses')
+            return None
+        now = time.time()
+        if now - row[1] > self.access_interval:
+            with self._transaction():
+                self.connection.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+        self._count('hits')
+        fixed, log = json.loads(zlib.decompress(row[0]))
+        return fixed, log
+
+    def put(self, key, fixed, log):
+        value = zlib.compress(json.dumps([fixed, log]).encode('utf-8'))
+        with self._transaction():
+            row = self.connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)", (key, value, len(value), time.time())
+            )
+            self._increment('bytes', len(value) - (row[0] if row else 0))
+            self._flush_pending()
+        if self.max_bytes and self.size() > self.max_bytes:
+            # evict a little more than needed, so that the next puts do not evict again
+            self.evict(int(self.max_bytes * 0.9))
+
+    def size(self):
+        """
+        Total size of the compressed entries in bytes
+        """
+        return self.connection.execute("SELECT value FROM stats WHERE name = 'bytes'").fetchone()[0]
+
+    def evict(self, max_bytes):
+        """
+        Remove the least recently used entries until the total size is at most max_bytes
+        """
+        with self._transaction():
+            excess = self.size() - max_bytes
+            if excess <= 0:
+                return
+            keys, evicted = [], 0
+            for key, size in self.connection.execute("SELECT key, size FROM entries ORDER BY last_access"):
+                if evicted >= excess:
+                    break
+                keys.append((key,))
+                evicted += size
+            self.connection.executemany("DELETE FROM entries WHERE key = ?", keys)
+            self._increment('evictions', len(keys))
+            self._increment('bytes', -evicted)
+
+    def stats(self):
+        """
+        :return: numbers of hits, misses, evictions and entries, and the total size of the entries in bytes
+            (including the hits and misses of this process that are not in the database yet)
+        """
+        stats = dict(self.connection.execute("SELECT name, value FROM stats").fetchall())
+        for name, value in self.pending.items():
+            stats[name] += value
+        stats['entries'] = self.connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return stats
+
+    def report(self, since=None):
+        """
+        Print the hits and misses since the given stats, and the size of the cache
+        :param since: stats() at the start of the run
+        """
+        stats = self.stats()
+        hits = stats['hits'] - (since['hits'] if since else 0)
+        misses = stats['misses'] - (since['misses'] if since else 0)
+        print(f"Cache: {hits} hits, {misses} misses ({hits / max(hits + misses, 1):.1%} hit rate), "
+              f"{stats['entries']} entries, {stats['bytes'] / (1 << 20):.1f}MB")
+
+    def _close(self):
+        self.flush()
+        self.connection.close()
+        _caches.pop((os.getpid(), os.path.abspath(self.path)), None)
+
+    def close(self):
+        # runs _close once, also at the exit of the process
+        self._finalizer()
+
+
+def add_cache_arguments(parser):
+    parser.add_argument('--cache', type=str, default=None,
+                        help='sqlite file of the augmentation cache (default: no cache)')
+    parser.add_argument('--cache_size', type=float, default=10,
+                        help='maximum size of the augmentation cache in GB')
+
+
+def open_cache(args):
+    """
+    Cache given by the --cache and --cache_size arguments, or None
+    """
+    if not args.cache:
+        return None
+    return get_cache(args.cache, int(args.cache_size * (1 << 30)))
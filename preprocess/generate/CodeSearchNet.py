@@ -3,12 +3,18 @@ import os
 import gzip
 import json
 from datetime import date
-from tqdm_pathos import starmap
+from itertools import islice
 import libcst as cst
 
 from preprocess.transform.remove_unassigned_strings import RemoveUnassignedStringTransformer
-from preprocess.transform.utils.tools import transform
-from preprocess.augment import augment
+from preprocess.transform.utils.tools import transform_module
+from preprocess.generate.executor import AugmentationExecutor, add_executor_arguments
+from preprocess.augment import count_skipped_stages
+from preprocess.cache import add_cache_arguments, open_cache
+from preprocess.generate.columnar import COLUMNAR_FORMATS, ColumnarWriter, get_CodeSearchNet_schema, \
+    flatten_CodeSearchNet
+from preprocess.generate.shards import get_shard_path, get_shard_paths, iter_shards, augment_or_skip, ShardManifest, \
+    ShardWriter
 
 from argparse import ArgumentParser
 
@@ -25,10 +31,36 @@ def parse_CodeSearchNet():
                         help='filename')
     parser.add_argument('--postfix', '-pf', type=str, default='',
                         help='postfix to save path')
+    parser.add_argument('--stream', '-s', action='store_true',
+                        help='read the data line by line and save jsonl shards as they finish')
+    parser.add_argument('--shard_size', '-ss', type=int, default=10000,
+                        help='number of input lines per shard (stream mode)')
+    parser.add_argument('--chunk_size', '-cs', type=int, default=1000,
+                        help='number of input lines augmented at once (stream mode)')
+    parser.add_argument('--compress', '-c', action='store_true',
+                        help='gzip-compress the shards (stream mode)')
+    parser.add_argument('--format', '-f', type=str, default='json', choices=('json',) + COLUMNAR_FORMATS,
+                        help='json (jsonl shards in stream mode), or flat columns in parquet or arrow files')
+    parser.add_argument('--row_group_size', '-rg', type=int, default=10000,
+                        help='number of rows per row group (parquet) or record batch (arrow)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, each item is augmented with a seed derived from it')
+    parser.add_argument('--date', type=str, default=None,
+                        help='date used in the save path (mmddyy), set it to resume a job started on another day')
+    parser.add_argument('--stage_timeout', '-st', type=float, default=60,
+                        help='seconds after which a transformation stage is skipped (0: no limit)')
+    parser.add_argument('--max_nodes', '-mn', type=int, default=0,
+                        help='skip the transformation stages of codes with more CST nodes (0: no limit)')
+    parser.add_argument('--reparse', action='store_true',
+                        help='print and parse the code again after each transformation stage, as before the '
+                             'single-parse pipeline (to reproduce datasets generated that way; the augmentations '
+                             'differ, e.g., new lines added by a stage are only removed by a later stage after a reparse)')
+    add_executor_arguments(parser)
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
 
-    today = date.today().strftime("%m%d%y")
+    today = args.date if args.date else date.today().strftime("%m%d%y")
 
     # read path
     data_original_dir = os.path.join(args.data_dir, "final", "jsonl")
@@ -38,35 +70,74 @@ def parse_CodeSearchNet():
     # save path
     data_augmented_dir = os.path.join(args.data_dir, "augmented")
     save_dir = os.path.join(data_augmented_dir, args.mode, args.filename, today)
-    save_name = f"augmented_{str(args.p)}{'_' + args.postfix if args.postfix else ''}.json"
+    save_name = f"augmented_{str(args.p)}{'_' + args.postfix if args.postfix else ''}.{args.format}"
     os.makedirs(save_dir, exist_ok=True)
     save_path = os.path.join(save_dir, save_name)
 
     info = {
             'source_filename': source_filename,
             'date': today,
-            'p': args.p
+            'p': args.p,
+            'seed': args.seed,
+            'reparse': args.reparse
         }
 
     print(args)
     print(info)
     return args, (read_path, save_path, info)
 
-def filter_valid_parse(line):
+def augment_line(line, ps, seed, sample_id, stage_timeout=None, max_nodes=None, cache=None, reparse=False):
+    """
+    Parse test, docstring removal and augmentation of one item on a single parsed tree
+    :param line: json line of the item
+    :param ps: temperatures
+    :param seed: global seed, the item is augmented with a generator derived from (seed, sample_id, p)
+    :param sample_id: input offset of the item
+    :param stage_timeout: seconds after which a transformation stage is skipped
+    :param max_nodes: skip the transformation stages if the code has more nodes
+    :param cache: AugmentationCache of the augmented codes
+    :param reparse: print and parse the code after each stage instead of using the pipeline mode of augment
+    :return: new json item, or None if the code could not be parsed
+    """
     item = json.loads(line)
     try:
-        cst.parse_module(item["code"])
-        return item
+        source_module = cst.parse_module(item["code"])
     except:
         return None
 
+    # remove docstrings
+    source_module, _ = transform_module(source_module, RemoveUnassignedStringTransformer, (1,))
+    item['code'] = source_module.code
+
+    augmented = []
+    for p in ps:
+        fixed, log = augment_or_skip(
+            source_module, [], float(p), None, parse_test=reparse, pipeline=not reparse, final_parse_test=True,
+            stage_timeout=stage_timeout, max_nodes=max_nodes, skip_failed_stages=True, seed=seed, sample_id=sample_id,
+            cache=cache
+        )
+        augmented.append({
+            'code': fixed,
+            'log': log,
+            'temp': p
+        })
+    return {
+        'sample_id': sample_id,
+        'original': item,
+        'augmented': augmented
+    }
+
 
-def remove_docstring(json_item):
-    json_item['code'], _ = transform(
-        json_item['code'],
-        *(RemoveUnassignedStringTransformer, (1,))
+def augment_lines(executor, args, lines, start=0):
+    """
+    :param start: input offset of the first line, used to derive the seed of each item
+    """
+    results = executor.starmap(
+        augment_line,
+        [(line, args.p, args.seed, start + i, args.stage_timeout, args.max_nodes, open_cache(args), args.reparse)
+         for i, line in enumerate(lines)]
     )
-    return json_item
+    return [new_json_item for new_json_item in results if new_json_item]
 
 
 def generate(args, read_path, save_path, info):
@@ -74,38 +145,29 @@ def generate(args, read_path, save_path, info):
     with gzip.open(read_path, "r") as f:
         data = f.read().decode('utf-8')
 
-        lines = [[line] for line in data.split('\n')]
+        lines = data.split('\n')
 
-    # filter by parse test
-    json_list = [item for item in starmap(filter_valid_parse, lines) if item]
+    cache = open_cache(args)
+    cache_stats = cache.stats() if cache else None
+    with AugmentationExecutor.from_args(args) as executor:
+        new_json_list = augment_lines(executor, args, lines)
 
-    # remove docstrings
-    json_list = starmap(
-        remove_docstring,
-        [(json_item,) for json_item in json_list]
+    skipped = count_skipped_stages(
+        augmented['log'] for new_json_item in new_json_list for augmented in new_json_item['augmented']
     )
+    print(f'Skipped stages: {skipped}')
+    if cache:
+        cache.report(cache_stats)
 
-    results = starmap(
-            augment,
-            [(json_item['code'], [], float(p), None, True) for json_item in json_list for p in args.p]
-        )
-
-    new_json_list = []
-    for i, item in enumerate(json_list):
-        new_json_item = {
-            'original': item,
-            'augmented': [
-                {
-                    'code': results[i * len(args.p) + j][0],
-                    'log': results[i * len(args.p) + j][1],
-                    'temp': p
-                } for j, p in enumerate(args.p)
-            ]
-        }
-        new_json_list.append(new_json_item)
+    if args.format != 'json':
+        writer = ColumnarWriter(save_path, get_CodeSearchNet_schema(dict(info, skipped=skipped)),
+                                flatten_CodeSearchNet, args.row_group_size)
+        writer.write(new_json_list)
+        writer.close()
+        return
 
     to_save = {
-        'transform_info': info,
+        'transform_info': dict(info, skipped=skipped),
         'data': new_json_list
     }
 
@@ -113,6 +175,70 @@ def generate(args, read_path, save_path, info):
         f.write(json.dumps(to_save))
     print(f'Saved: {save_path}')
 
+
+def open_shard_writer(args, shard_path, info):
+    if args.format == 'json':
+        return ShardWriter(shard_path)
+    return ColumnarWriter(shard_path, get_CodeSearchNet_schema(info), flatten_CodeSearchNet, args.row_group_size)
+
+
+def read_lines(read_path):
+    with gzip.open(read_path, "rt", encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+
+def generate_streaming(args, read_path, shard_dir, info):
+    """
+    Augment the data chunk by chunk and save the results to jsonl shards of args.shard_size input lines
+    Only one chunk is kept in memory at a time.
+    Completed shards are recorded in a manifest, so that a job restarted with the same arguments skips them.
+    """
+    manifest = ShardManifest(shard_dir, dict(info, shard_size=args.shard_size, compress=args.compress,
+                                             format=args.format, stage_timeout=args.stage_timeout,
+                                             max_nodes=args.max_nodes))
+
+    cache = open_cache(args)
+    cache_stats = cache.stats() if cache else None
+    with AugmentationExecutor.from_args(args) as executor:
+        lines = read_lines(read_path)
+        shard_index = 0
+        while True:
+            start = shard_index * args.shard_size
+            shard_lines = islice(lines, args.shard_size)
+            if manifest.is_complete(shard_index):
+                for _ in shard_lines:
+                    pass
+                print(f'Skipped completed shard {shard_index}')
+                shard_index += 1
+                continue
+
+            chunk = list(islice(shard_lines, args.chunk_size))
+            if not chunk:
+                break
+
+            shard_path = get_shard_path(shard_dir, shard_index, args.compress, args.format)
+            writer = open_shard_writer(args, shard_path, info)
+            end = start
+            skipped = []
+            while chunk:
+                new_json_list = augment_lines(executor, args, chunk, end)
+                writer.write(new_json_list)
+                skipped.append(count_skipped_stages(
+                    augmented['log'] for new_json_item in new_json_list for augmented in new_json_item['augmented']
+                ))
+                end += len(chunk)
+                chunk = list(islice(shard_lines, args.chunk_size))
+            writer.close()
+            manifest.complete(shard_index, shard_path, start, end, writer.num_items, count_skipped_stages(skipped))
+            shard_index += 1
+
+    print(f'Skipped stages: {manifest.count_skipped()}')
+    if cache:
+        cache.report(cache_stats)
+
+
 def read_generated(save_path):
     with open(save_path, 'r') as f:
         data = json.load(f)
@@ -122,6 +248,16 @@ def read_generated(save_path):
 if __name__ == '__main__':
     args, (read_path, save_path, info) = parse_CodeSearchNet()
 
-    generate(args, read_path, save_path, info)
+    if args.stream:
+        shard_dir = os.path.splitext(save_path)[0]
+        generate_streaming(args, read_path, shard_dir, info)
+
+        if args.format == 'json':
+            print(sum(1 for _ in iter_shards(shard_dir)))
+        else:
+            print(get_shard_paths(shard_dir))
+    else:
+        generate(args, read_path, save_path, info)
 
-    read_generated(save_path)
\ No newline at end of file
+        if args.format == 'json':
+            read_generated(save_path)
@@ -1,15 +1,19 @@
-from datasets import load_dataset, load_from_disk
+from datasets import load_dataset, load_from_disk, IterableDataset
 from argparse import ArgumentParser
 import libcst as cst
-from tqdm_pathos import starmap
-from tqdm import tqdm
 
 import os
 import json
+import hashlib
+from collections import OrderedDict
 from datetime import date
+from itertools import islice
 
-from preprocess.augment import augment
-
+from preprocess.generate.executor import AugmentationExecutor, add_executor_arguments
+from preprocess.augment import count_skipped_stages
+from preprocess.cache import add_cache_arguments, open_cache
+from preprocess.generate.columnar import COLUMNAR_FORMATS, ColumnarWriter, get_PoolC_schema, flatten_PoolC
+from preprocess.generate.shards import get_shard_path, augment_or_skip, ShardManifest, ShardWriter
 
 
 def parse_PoolC():
@@ -22,25 +26,55 @@ def parse_PoolC():
     parser.add_argument('--dataset_name', '-name', type=str, default="PoolC/1-fold-clone-detection-600k-5fold",
                         help='dataset name or path')
     parser.add_argument('--load_from_disk', '-ld', action='store_true')
+    parser.add_argument('--streaming', '-sm', action='store_true',
+                        help='stream the dataset instead of downloading it (with load_dataset)')
     parser.add_argument('--mode', '-m', type=str, default='train',
                         help='mode: train, val')
     parser.add_argument('--postfix', '-pf', type=str, default='',
                         help='postfix to save path')
     parser.add_argument('--num_datapoint', '-n', type=int, default=33000,
-                        help='number of datapoint to augment')
+                        help='number of datapoint to augment (pairs that cannot be parsed are not counted)')
+    parser.add_argument('--batch_size', '-bs', type=int, default=1000,
+                        help='number of rows read, parse-tested and augmented at once')
+    parser.add_argument('--shard_size', '-ss', type=int, default=0,
+                        help='save shards of this many datapoints, and skip completed shards on restart (0: off)')
+    parser.add_argument('--compress', '-c', action='store_true',
+                        help='gzip-compress the shards')
+    parser.add_argument('--format', '-f', type=str, default='arrow', choices=('json',) + COLUMNAR_FORMATS,
+                        help='json (jsonl shards if sharded), or flat columns in parquet or arrow files')
+    parser.add_argument('--row_group_size', '-rg', type=int, default=10000,
+                        help='number of rows per row group (parquet) or record batch (arrow)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, each code is augmented with a seed derived from it')
+    parser.add_argument('--max_snippets', '-ms', type=int, default=50000,
+                        help='number of recently augmented snippets kept in memory to reuse for duplicates')
+    parser.add_argument('--date', type=str, default=None,
+                        help='date used in the save path (mmddyy), set it to resume a job started on another day')
+    parser.add_argument('--stage_timeout', '-st', type=float, default=60,
+                        help='seconds after which a transformation stage is skipped (0: no limit)')
+    parser.add_argument('--max_nodes', '-mn', type=int, default=0,
+                        help='skip the transformation stages of codes with more CST nodes (0: no limit)')
+    parser.add_argument('--reparse', action='store_true',
+                        help='print and parse the code again after each transformation stage, as before the '
+                             'single-parse pipeline (to reproduce datasets generated that way; the augmentations '
+                             'differ, e.g., new lines added by a stage are only removed by a later stage after a reparse)')
+    add_executor_arguments(parser)
+    add_cache_arguments(parser)
 
     args = parser.parse_args()
 
-    today = date.today().strftime("%m%d%y")
+    today = args.date if args.date else date.today().strftime("%m%d%y")
 
     save_dir = os.path.join(args.data_dir, args.mode, today)
-    save_name = f"augmented_{str(args.p)}{'_' + args.postfix if args.postfix else ''}.json"
+    save_name = f"augmented_{str(args.p)}{'_' + args.postfix if args.postfix else ''}.{args.format}"
     os.makedirs(save_dir, exist_ok=True)
     args.save_path = os.path.join(save_dir, save_name)
 
     args.info = {
         'date': today,
-        'p': args.p
+        'p': args.p,
+        'seed': args.seed,
+        'reparse': args.reparse
     }
 
 
@@ -49,55 +83,183 @@ def parse_PoolC():
     return args
 
 
-def filter_valid_parse(data):
+def is_valid_parse(data):
     try:
         cst.parse_module(data["code1"])
         cst.parse_module(data["code2"])
-        return data
-    except:
-        return None
+        return True
+    except Exception:
+        return False
 
-def generate(args):
-    """ Note: did not remove docstrings in this case """
+def augment_code(code, p, seed, sample_id, stage_timeout=None, max_nodes=None, cache=None, reparse=False):
+    """
+    :param reparse: print and parse the code after each stage instead of using the pipeline mode of augment
+    """
+    return augment_or_skip(
+        code, [], float(p), None, parse_test=reparse, pipeline=not reparse, final_parse_test=True,
+        stage_timeout=stage_timeout, max_nodes=max_nodes, skip_failed_stages=True, seed=seed, sample_id=sample_id,
+        cache=cache
+    )
+
+
+def count_skipped(new_json_list):
+    return count_skipped_stages(
+        augmented[key] for new_json_item in new_json_list for augmented in new_json_item['augmented']
+        for key in ['code1_log', 'code2_log']
+    )
+
+
+def load(args):
     if args.load_from_disk:
-        _dataset = load_from_disk(args.dataset_name)[args.mode]
-    else:
-        _dataset = load_dataset(args.dataset_name, split=args.mode)
-    dataset = []
-    for i in tqdm(range(min(args.num_datapoint, len(_dataset)))):
-        dataset.append([_dataset[i]])
-
-    # filter by parse test
-    print('parse test...')
-    dataset = [data for data in starmap(filter_valid_parse, dataset) if data]
-    dataset = dataset[:args.num_datapoint]
-
-    print('augment...')
-    results = {}
-    for key in ['code1', 'code2']:
-        results[key] = starmap(
-            augment,
-            [(data[key], [], float(p), None, True) for data in dataset for p in args.p]
+        return load_from_disk(args.dataset_name)[args.mode]
+    return load_dataset(args.dataset_name, split=args.mode, streaming=args.streaming)
+
+
+def iter_batches(dataset, batch_size, start=0):
+    """
+    Rows of the dataset from the start-th one, in lists of batch_size rows
+    Each batch is read from the Arrow table (or the stream) at once instead of row by row.
+    """
+    if start:
+        if isinstance(dataset, IterableDataset):
+            dataset = dataset.skip(start)
+        else:
+            dataset = dataset.select(range(start, len(dataset)))
+    for batch in dataset.iter(batch_size=batch_size):
+        yield [dict(zip(batch, values)) for values in zip(*batch.values())]
+
+
+def iter_valid_pairs(executor, dataset, batch_size, start=0):
+    """
+    (index, data) of the pairs of the dataset that pass the parse test, from the start-th row
+    The rows are read and parse-tested batch_size at a time, so that no more than one batch is read
+    after the consumer stops.
+    """
+    for batch in iter_batches(dataset, batch_size, start):
+        is_valid = executor.starmap(
+            is_valid_parse, [(data,) for data in batch], [len(data['code1']) + len(data['code2']) for data in batch]
         )
+        for i, data in enumerate(batch):
+            if is_valid[i]:
+                yield start + i, data
+        start += len(batch)
+
+
+def snippet_hash(code):
+    return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+
+class AugmentedSnippets(OrderedDict):
+    """
+    Augmentations of the snippets keyed by (content hash, p), shared by all pairs containing the snippet
+    The least recently used ones are dropped when there are more than max_size.
+    """
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+        self.num_codes = 0
+        self.num_augmented = 0
+
+    def get(self, key, default=None):
+        if key in self:
+            self.move_to_end(key)
+        return super().get(key, default)
+
+    def update_all(self, items):
+        for key, value in items:
+            self[key] = value
+            self.move_to_end(key)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+    def report(self):
+        print(f'Augmented {self.num_augmented} unique snippets for {self.num_codes} codes')
+
+
+def augment_pairs(executor, args, pairs, snippets):
+    """
+    Augment both sides of the pairs in one pass, each distinct snippet once for each p
+    A snippet is augmented with a seed derived from its content, so duplicates have the same augmentations.
+    :param pairs: list of (index, data)
+    :param snippets: AugmentedSnippets, reused across calls
+    """
+    codes, pair_hashes = {}, []
+    for i, data in pairs:
+        pair_hashes.append((snippet_hash(data['code1']), snippet_hash(data['code2'])))
+        codes.update(zip(pair_hashes[-1], (data['code1'], data['code2'])))
+    results = {(code_hash, p): snippets.get((code_hash, p)) for code_hash in codes for p in args.p
+               if (code_hash, p) in snippets}
+    missing = [(code_hash, p) for code_hash in codes for p in args.p if (code_hash, p) not in results]
+    new_results = executor.starmap(
+        augment_code,
+        [(codes[code_hash], p, args.seed, code_hash, args.stage_timeout, args.max_nodes, open_cache(args),
+          args.reparse) for code_hash, p in missing],
+        [len(codes[code_hash]) for code_hash, p in missing]
+    )
+    snippets.update_all(zip(missing, new_results))
+    results.update(zip(missing, new_results))
+    snippets.num_codes += 2 * len(pairs) * len(args.p)
+    snippets.num_augmented += len(missing)
 
-    print('save...')
     new_json_list = []
-    for i, data in tqdm(enumerate(dataset)):
-        new_json_item = {
+    for (sample_id, data), (code1_hash, code2_hash) in zip(pairs, pair_hashes):
+        augmented = []
+        for p in args.p:
+            code1, code1_log = results[(code1_hash, p)]
+            code2, code2_log = results[(code2_hash, p)]
+            augmented.append({'code1': code1, 'code1_log': code1_log, 'code2': code2, 'code2_log': code2_log,
+                              'temp': p})
+        new_json_list.append({
+            'sample_id': sample_id,
             'original': data,
-            'augmented': [
-                {
-                    'code1': results['code1'][i * len(args.p) + j][0],
-                    'code1_log': results['code1'][i * len(args.p) + j][1],
-                    'code2': results['code2'][i * len(args.p) + j][0],
-                    'code2_log': results['code2'][i * len(args.p) + j][1],
-                } for j, p in enumerate(args.p)
-            ]
-        }
-        new_json_list.append(new_json_item)
+            'augmented': augmented
+        })
+    return new_json_list
+
+
+def generate(args):
+    """
+    Augment the first args.num_datapoint pairs that can be parsed, args.batch_size pairs at a time
+    Columnar outputs are written batch by batch, json is saved at the end.
+    Note: did not remove docstrings in this case
+    """
+    writer = None
+    if args.format != 'json':
+        writer = ColumnarWriter(args.save_path, get_PoolC_schema(args.info), flatten_PoolC, args.row_group_size)
 
+    cache = open_cache(args)
+    cache_stats = cache.stats() if cache else None
+    new_json_list, skipped = [], []
+    snippets = AugmentedSnippets(args.max_snippets)
+    num_pairs, num_rows = 0, 0
+    with AugmentationExecutor.from_args(args) as executor:
+        pairs = islice(iter_valid_pairs(executor, load(args), args.batch_size), args.num_datapoint)
+        chunk = list(islice(pairs, args.batch_size))
+        while chunk:
+            new_json_items = augment_pairs(executor, args, chunk, snippets)
+            skipped.append(count_skipped(new_json_items))
+            if writer:
+                writer.write(new_json_items)
+            else:
+                new_json_list += new_json_items
+            num_pairs, num_rows = num_pairs + len(chunk), chunk[-1][0] + 1
+            chunk = list(islice(pairs, args.batch_size))
+
+    print(f'{num_pairs} pairs augmented from {num_rows} rows read')
+    skipped = count_skipped_stages(skipped)
+    print(f'Skipped stages: {skipped}')
+    snippets.report()
+    if cache:
+        cache.report(cache_stats)
+
+    if writer:
+        writer.close()
+        return
+
+    print('save...')
     to_save = {
-        'transform_info': args.info,
+        'transform_info': dict(args.info, skipped=skipped),
         'data': new_json_list
     }
 
@@ -105,9 +267,78 @@ def generate(args):
         f.write(json.dumps(to_save))
     print(f'Saved: {args.save_path}')
 
+
+def open_shard_writer(args, shard_path):
+    if args.format == 'json':
+        return ShardWriter(shard_path)
+    return ColumnarWriter(shard_path, get_PoolC_schema(args.info), flatten_PoolC, args.row_group_size)
+
+
+def generate_sharded(args):
+    """
+    Same as generate, but saves shards of args.shard_size datapoints as they finish
+    Completed shards are recorded in a manifest with the rows [start, end) they were read from, so that a job
+    restarted with the same arguments skips them. The rows of the leading completed shards are not read again.
+    """
+    shard_dir = os.path.splitext(args.save_path)[0]
+    manifest = ShardManifest(shard_dir, dict(
+        args.info, dataset_name=args.dataset_name, mode=args.mode, num_datapoint=args.num_datapoint,
+        shard_size=args.shard_size, compress=args.compress, format=args.format,
+        stage_timeout=args.stage_timeout, max_nodes=args.max_nodes
+    ))
+
+    shard_index, position, num_items = 0, 0, 0
+    while manifest.is_complete(shard_index) and manifest.shards[str(shard_index)]['start'] == position:
+        position = manifest.shards[str(shard_index)]['end']
+        num_items += manifest.shards[str(shard_index)]['num_items']
+        print(f'Skipped completed shard {shard_index}')
+        shard_index += 1
+
+    cache = open_cache(args)
+    cache_stats = cache.stats() if cache else None
+    snippets = AugmentedSnippets(args.max_snippets)
+    with AugmentationExecutor.from_args(args) as executor:
+        pairs = islice(iter_valid_pairs(executor, load(args), args.batch_size, position),
+                       max(args.num_datapoint - num_items, 0))
+        while True:
+            shard_pairs = islice(pairs, args.shard_size)
+            if manifest.is_complete(shard_index):
+                for _ in shard_pairs:
+                    pass
+                position = manifest.shards[str(shard_index)]['end']
+                print(f'Skipped completed shard {shard_index}')
+                shard_index += 1
+                continue
+
+            chunk = list(islice(shard_pairs, args.batch_size))
+            if not chunk:
+                break
+
+            shard_path = get_shard_path(shard_dir, shard_index, args.compress, args.format)
+            writer = open_shard_writer(args, shard_path)
+            start, skipped = position, []
+            while chunk:
+                new_json_list = augment_pairs(executor, args, chunk, snippets)
+                writer.write(new_json_list)
+                skipped.append(count_skipped(new_json_list))
+                position = chunk[-1][0] + 1
+                chunk = list(islice(shard_pairs, args.batch_size))
+            writer.close()
+            manifest.complete(shard_index, shard_path, start, position, writer.num_items, count_skipped_stages(skipped))
+            shard_index += 1
+
+    print(f'Skipped stages: {manifest.count_skipped()}')
+    snippets.report()
+    if cache:
+        cache.report(cache_stats)
+
+
 if __name__ == '__main__':
     args = parse_PoolC()
-    generate(args)
+    if args.shard_size:
+        generate_sharded(args)
+    else:
+        generate(args)
 
 
 
@@ -0,0 +1,182 @@
+"""
+Columnar (Parquet / Arrow IPC) output of the augmented datasets
+Each row is one code: the original (aug_index -1) or one of its augmentations, with the number of changes of each
+transformer in its own integer column, so that loaders can read only the columns they need and filter by the logs
+without deserializing the codes. pyarrow is only imported when a columnar format is used.
+"""
+import os
+import json
+from functools import lru_cache
+
+from preprocess.augment import get_default_args_list
+from preprocess.transform.applicability import get_empty_logs
+
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+
+
+@lru_cache(maxsize=None)
+def get_log_columns():
+    """
+    Log keys of the default stages of augment, in a sorted order
+    """
+    log_columns = set()
+    for args in get_default_args_list():
+        log_columns.update(get_empty_logs(args))
+    return tuple(sorted(log_columns))
+
+
+def count_skipped(log):
+    return sum(value for key, value in log.items() if key.startswith("skipped:"))
+
+
+def get_schema(code_columns, extra_fields=(), transform_info=None):
+    """
+    :param code_columns: names of the code columns, each followed by its log columns ('<code>_<log key>')
+    :param extra_fields: other pyarrow fields of the originals (e.g., labels)
+    :param transform_info: saved in the metadata of the schema
+    """
+    import pyarrow as pa
+
+    fields = [
+        pa.field('sample_id', pa.int64()),
+        pa.field('p', pa.float32()),
+        pa.field('aug_index', pa.int32()),
+    ]
+    fields += list(extra_fields)
+    for code_column in code_columns:
+        fields.append(pa.field(code_column, pa.large_string()))
+        prefix = code_column + '_' if len(code_columns) > 1 else ''
+        fields += [pa.field(prefix + key, pa.int32()) for key in get_log_columns()]
+        fields.append(pa.field(prefix + 'num_skipped', pa.int32()))
+    metadata = {'transform_info': json.dumps(transform_info)} if transform_info is not None else None
+    return pa.schema(fields, metadata=metadata)
+
+
+def get_CodeSearchNet_schema(transform_info=None):
+    return get_schema(['code'], transform_info=transform_info)
+
+
+def get_PoolC_schema(transform_info=None):
+    import pyarrow as pa
+
+    return get_schema(['code1', 'code2'], [pa.field('similar', pa.int64())], transform_info)
+
+
+def _log_values(log, prefix=''):
+    values = {prefix + key: log.get(key, 0) for key in get_log_columns()}
+    values[prefix + 'num_skipped'] = count_skipped(log)
+    return values
+
+
+def flatten_CodeSearchNet(new_json_item):
+    """
+    Rows of an item of CodeSearchNet.augment_line
+    """
+    sample_id = new_json_item['sample_id']
+    rows = [dict(sample_id=sample_id, p=None, aug_index=-1, code=new_json_item['original']['code'],
+                 **_log_values({}))]
+    for aug_index, augmented in enumerate(new_json_item['augmented']):
+        rows.append(dict(sample_id=sample_id, p=float(augmented['temp']), aug_index=aug_index,
+                         code=augmented['code'], **_log_values(augmented['log'])))
+    return rows
+
+
+def flatten_PoolC(new_json_item):
+    """
+    Rows of an item of PoolC.augment_pairs
+    """
+    sample_id = new_json_item['sample_id']
+    original = new_json_item['original']
+    rows = [dict(sample_id=sample_id, p=None, aug_index=-1, similar=original.get('similar'),
+                 code1=original['code1'], **_log_values({}, 'code1_'),
+                 code2=original['code2'], **_log_values({}, 'code2_'))]
+    for aug_index, augmented in enumerate(new_json_item['augmented']):
+        rows.append(dict(sample_id=sample_id, p=float(augmented['temp']), aug_index=aug_index,
+                         similar=original.get('similar'),
+                         code1=augmented['code1'], **_log_values(augmented['code1_log'], 'code1_'),
+                         code2=augmented['code2'], **_log_values(augmented['code2_log'], 'code2_')))
+    return rows
+
+
+class ColumnarWriter:
+    """
+    Same interface as shards.ShardWriter, but flattens the items to rows and writes them in row groups
+    (Parquet) or record batches (Arrow IPC file, which can be memory-mapped) of row_group_size rows
+    The file is written to a temporary file that is renamed to path when closed.
+    """
+
+    def __init__(self, path, schema, flatten, row_group_size=10000):
+        """
+        :param path: .parquet or .arrow file
+        :param schema: pyarrow schema of the rows
+        :param flatten: function returning the rows of an item
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.path = path
+        self.schema = schema
+        self.flatten = flatten
+        self.row_group_size = row_group_size
+        self.rows = []
+        self.num_items = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if path.endswith('.parquet'):
+            self.sink = None
+            self.writer = pq.ParquetWriter(path + '.tmp', schema, compression='zstd')
+        elif path.endswith('.arrow'):
+            self.sink = pa.OSFile(path + '.tmp', 'wb')
+            self.writer = pa.ipc.new_file(self.sink, schema)
+        else:
+            raise ValueError(f"Unknown columnar format: {path}")
+
+    def _write_rows(self, rows):
+        import pyarrow as pa
+
+        table = pa.Table.from_pylist(rows, schema=self.schema)
+        if self.sink is None:
+            self.writer.write_table(table, row_group_size=self.row_group_size)
+        else:
+            self.writer.write_table(table, max_chunksize=self.row_group_size)
+
+    def write(self, items):
+        for item in items:
+            self.rows += self.flatten(item)
+            self.num_items += 1
+        while len(self.rows) >= self.row_group_size:
+            self._write_rows(self.rows[:self.row_group_size])
+            self.rows = self.rows[self.row_group_size:]
+
+    def close(self):
+        if self.rows:
+            self._write_rows(self.rows)
+            self.rows = []
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+        os.replace(self.path + '.tmp', self.path)
+        print(f'Saved: {self.path}')
+
+
+def load_table(paths, columns=None, filter=None):
+    """
+    Read the given columns of the rows that pass filter from columnar files
+    Arrow IPC files are memory-mapped, and Parquet files only read the row groups and columns that are needed.
+    :param paths: a file or a list of files of the same format
+    :param columns: names of the columns (default: all)
+    :param filter: pyarrow.dataset expression, e.g., pyarrow.dataset.field('change_variable_names') > 0
+    :return: pyarrow.Table
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    if isinstance(paths, str):
+        paths = [paths]
+    if paths and paths[0].endswith('.arrow'):
+        tables = [pa.ipc.open_file(pa.memory_map(path, 'r')).read_all() for path in paths]
+        dataset = ds.dataset(pa.concat_tables(tables))
+    else:
+        dataset = ds.dataset(paths, format='parquet')
+    return dataset.to_table(columns=columns, filter=filter)
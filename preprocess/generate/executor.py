@@ -0,0 +1,124 @@
+import os
+import time
+from collections import defaultdict
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+
+def _run_chunk(task):
+    func, indices, args_chunk = task
+    start = time.perf_counter()
+    results = [func(*args) for args in args_chunk]
+    return os.getpid(), indices, results, time.perf_counter() - start
+
+
+def make_chunks(costs, chunk_cost, max_chunk_size):
+    """
+    Group task indices into chunks of about chunk_cost, largest tasks first
+    The largest tasks get chunks of their own and start first, and the small tasks at the end fill in the tail
+    :return: list of lists of task indices
+    """
+    chunks, chunk, total = [], [], 0
+    for i in sorted(range(len(costs)), key=lambda i: -costs[i]):
+        chunk.append(i)
+        total += costs[i]
+        if total >= chunk_cost or len(chunk) >= max_chunk_size:
+            chunks.append(chunk)
+            chunk, total = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+class AugmentationExecutor:
+    """
+    Process pool for augmentation tasks whose costs vary widely
+    Tasks are chunked by cost (e.g., source length) and ordered largest first. Workers pull the next chunk as soon
+    as they are done (imap_unordered), so no worker waits on a fixed share of the tasks at the tail of a run.
+    """
+
+    def __init__(self, num_workers=None, maxtasksperchild=None, chunk_cost=20000, max_chunk_size=64):
+        """
+        :param num_workers: number of processes (None: os.cpu_count(), 0: run in the current process)
+        :param maxtasksperchild: number of chunks after which a worker is replaced
+        :param chunk_cost: target total cost of a chunk
+        :param max_chunk_size: maximum number of tasks in a chunk
+        """
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.maxtasksperchild = maxtasksperchild
+        self.chunk_cost = chunk_cost
+        self.max_chunk_size = max_chunk_size
+        self.pool = None
+
+        # per worker: number of tasks, total cost, busy seconds
+        self.stats = defaultdict(lambda: [0, 0, 0.0])
+        self.elapsed = 0.0
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.num_workers, args.maxtasksperchild, args.chunk_cost)
+
+    def __enter__(self):
+        if self.num_workers > 0:
+            self.pool = Pool(self.num_workers, maxtasksperchild=self.maxtasksperchild)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.report()
+
+    def starmap(self, func, args_list, costs=None, callback=None):
+        """
+        Same as starmap(func, args_list), results are in the order of args_list
+        :param costs: cost of each task, the length of the first argument by default
+        :param callback: called with (index, result) in the current process as soon as each result arrives
+        """
+        if costs is None:
+            costs = [len(args[0]) for args in args_list]
+        chunks = make_chunks(costs, self.chunk_cost, self.max_chunk_size)
+        tasks = [(func, chunk, [args_list[i] for i in chunk]) for chunk in chunks]
+
+        start = time.perf_counter()
+        results = [None] * len(args_list)
+        outputs = self.pool.imap_unordered(_run_chunk, tasks) if self.pool else map(_run_chunk, tasks)
+        with tqdm(total=len(args_list)) as pbar:
+            for pid, indices, chunk_results, elapsed in outputs:
+                for i, result in zip(indices, chunk_results):
+                    results[i] = result
+                    if callback is not None:
+                        callback(i, result)
+                stats = self.stats[pid]
+                stats[0] += len(indices)
+                stats[1] += sum(costs[i] for i in indices)
+                stats[2] += elapsed
+                pbar.update(len(indices))
+        self.elapsed += time.perf_counter() - start
+        return results
+
+    def report(self):
+        """
+        Print the throughput of each worker
+        """
+        if not self.stats:
+            return
+        busy = sum(stats[2] for stats in self.stats.values())
+        num_tasks = sum(stats[0] for stats in self.stats.values())
+        print(f'{num_tasks} tasks in {self.elapsed:.1f}s on {len(self.stats)} workers '
+              f'({num_tasks / max(self.elapsed, 1e-9):.1f} tasks/s, '
+              f'utilization {busy / max(self.elapsed * max(self.num_workers, 1), 1e-9):.0%})')
+        for pid, (n, cost, elapsed) in sorted(self.stats.items()):
+            print(f'  worker {pid}: {n} tasks, {n / max(elapsed, 1e-9):.1f} tasks/s, '
+                  f'{cost / max(elapsed, 1e-9):.0f} cost/s, busy {elapsed:.1f}s')
+
+
+def add_executor_arguments(parser):
+    parser.add_argument('--num_workers', '-nw', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs, 0: no pool)')
+    parser.add_argument('--maxtasksperchild', type=int, default=None,
+                        help='number of chunks after which a worker process is replaced')
+    parser.add_argument('--chunk_cost', type=int, default=20000,
+                        help='target number of source characters per chunk sent to a worker')
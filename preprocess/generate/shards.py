@@ -0,0 +1,142 @@
+import io
+import os
+import gzip
+import json
+import hashlib
+
+import libcst as cst
+
+from preprocess.augment import augment, count_skipped_stages
+
+
+def get_shard_path(shard_dir, shard_index, compress, format='json'):
+    """
+    :param format: 'json' for jsonl shards, or a columnar format ('parquet', 'arrow')
+    """
+    if format != 'json':
+        return os.path.join(shard_dir, f"shard_{shard_index:05d}.{format}")
+    return os.path.join(shard_dir, f"shard_{shard_index:05d}.jsonl{'.gz' if compress else ''}")
+
+
+def open_shard(shard_path, mode='rt'):
+    if shard_path.endswith('.gz') or shard_path.endswith('.gz.tmp'):
+        # no file name and modification time in the gzip header, so that the same content has the same checksum
+        gzip_file = gzip.GzipFile(filename='', mode=mode.replace('t', ''), fileobj=open(shard_path, mode.replace('t', 'b')),
+                                  mtime=0)
+        # close the underlying file together with the GzipFile
+        gzip_file.myfileobj = gzip_file.fileobj
+        return io.TextIOWrapper(gzip_file, encoding='utf-8')
+    return open(shard_path, mode.replace('t', ''), encoding='utf-8')
+
+
+def file_checksum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def get_shard_paths(shard_dir):
+    """
+    Paths of the completed shards of shard_dir in order
+    """
+    manifest = ShardManifest(shard_dir)
+    return [os.path.join(shard_dir, manifest.shards[shard_index]['path'])
+            for shard_index in sorted(manifest.shards, key=int)]
+
+
+def iter_shards(shard_dir):
+    """
+    Iterate over the items saved in the completed jsonl shards of shard_dir
+    """
+    for shard_path in get_shard_paths(shard_dir):
+        with open_shard(shard_path) as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def augment_or_skip(source, *args, **kwargs):
+    """
+    augment, but if the augmentation fails as a whole (e.g., the final code cannot be parsed),
+    the source is returned unchanged with a 'skipped:augment:error' log instead of aborting the job
+    """
+    try:
+        return augment(source, *args, **kwargs)
+    except Exception:
+        return source.code if isinstance(source, cst.Module) else source, {'skipped:augment:error': 1}
+
+
+class ShardManifest:
+    """
+    Progress of a sharded augmentation job, saved as manifest.json in the shard directory
+    For each completed shard: input offsets [start, end), number of saved items, file name and sha256 checksum
+    """
+
+    def __init__(self, shard_dir, info=None):
+        self.shard_dir = shard_dir
+        self.path = os.path.join(shard_dir, 'manifest.json')
+        self.info = info
+        self.shards = {}
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                manifest = json.load(f)
+            if info is not None and manifest['info'] != info:
+                raise ValueError(f"{self.path} was written with different arguments: {manifest['info']}")
+            self.info = manifest['info']
+            self.shards = manifest['shards']
+
+    def is_complete(self, shard_index):
+        shard = self.shards.get(str(shard_index))
+        if shard is None:
+            return False
+        shard_path = os.path.join(self.shard_dir, shard['path'])
+        return os.path.exists(shard_path) and file_checksum(shard_path) == shard['sha256']
+
+    def complete(self, shard_index, shard_path, start, end, num_items, skipped=None):
+        """
+        :param skipped: number of skipped stages in the shard, for each 'skipped:<name>:<reason>' key
+        """
+        self.shards[str(shard_index)] = {
+            'path': os.path.basename(shard_path),
+            'start': start,
+            'end': end,
+            'num_items': num_items,
+            'sha256': file_checksum(shard_path),
+            'skipped': skipped if skipped else {}
+        }
+        self.save()
+
+    def count_skipped(self):
+        return count_skipped_stages(shard.get('skipped', {}) for shard in self.shards.values())
+
+    def save(self):
+        os.makedirs(self.shard_dir, exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(json.dumps({'info': self.info, 'shards': self.shards}, indent=1))
+        os.replace(self.path + '.tmp', self.path)
+
+
+class ShardWriter:
+    """
+    Writes json items to a temporary file that is renamed to shard_path when closed,
+    so that an interrupted shard is never mistaken for a completed one
+    """
+
+    def __init__(self, shard_path):
+        self.shard_path = shard_path
+        os.makedirs(os.path.dirname(shard_path), exist_ok=True)
+        self.file = open_shard(shard_path + '.tmp', 'wt')
+        self.num_items = 0
+
+    def write(self, items):
+        for item in items:
+            self.file.write(json.dumps(item) + '\n')
+            self.num_items += 1
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        os.replace(self.shard_path + '.tmp', self.shard_path)
+        print(f'Saved: {self.shard_path}')
@@ -13,9 +13,10 @@ class AddNewLineTransformer(cst.CSTTransformer):
         def _validate(self) -> None:
             pass
 
-    def __init__(self, p):
+    def __init__(self, p, rng=None):
         # stack for storing the canonical name of the current function
         self.p = p
+        self.rng = rng if rng is not None else random
         self.num_changes = 0
 
     def get_logs(self):
@@ -24,7 +25,7 @@ class AddNewLineTransformer(cst.CSTTransformer):
     def leave_Newline(
             self, original_node: "Newline", updated_node: "Newline"
     ) -> "MyNewline":
-        if self.p != 1 and random.random() > self.p:
+        if self.p != 1 and self.rng.random() > self.p:
             return updated_node
         self.num_changes += 1
         return self.MyNewline("\n\n")
@@ -11,10 +11,11 @@ from libcst import MaybeSentinel
 
 class CommaTransformer(cst.CSTTransformer):
 
-    def __init__(self, add, p):
+    def __init__(self, add, p, rng=None):
         # stack for storing the canonical name of the current function
         self.func = self.add_comma_alike if add else self.remove_comma_alike
         self.p = p
+        self.rng = rng if rng is not None else random
         self.num_changes = 0
         self.add = add
 
@@ -24,7 +25,7 @@ class CommaTransformer(cst.CSTTransformer):
     def add_comma_alike(self, updated_node):
         if not self.add:
             return updated_node
-        if self.p != 1 and random.random() > self.p:
+        if self.p != 1 and self.rng.random() > self.p:
             return updated_node
         if len(updated_node.elements) > 0 and not m.matches(updated_node.elements[-1].comma, m.Comma()):
             self.num_changes += 1
@@ -38,7 +39,7 @@ class CommaTransformer(cst.CSTTransformer):
     def remove_comma_alike(self, updated_node):
         if self.add:
             return updated_node
-        if self.p != 1 and random.random() > self.p:
+        if self.p != 1 and self.rng.random() > self.p:
             return updated_node
         if len(updated_node.elements) > 0 and not m.matches(updated_node.elements[-1].comma, m.Comma()):
             self.num_changes += 1
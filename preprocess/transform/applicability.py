@@ -0,0 +1,106 @@
+"""
+Census of a module, and the stages that can possibly change it
+A stage is skipped if the nodes its transformer modifies are not in the census, since it would make no changes
+"""
+from collections import Counter
+
+import libcst as cst
+import libcst.matchers as m
+
+from preprocess.transform.add_remove_commas import CommaTransformer
+from preprocess.transform.change_comp_to_for import ChangeCompToForTransformer
+from preprocess.transform.change_for_range_to_while import ForToWhileTransformer
+from preprocess.transform.change_lambda_to_function import LambdaToFunctionTransformer
+from preprocess.transform.change_local_variable_names import ChangeLocalVariableNameTransformer
+from preprocess.transform.combine_statements import CombineStatementsTransformer
+from preprocess.transform.modify_whitespaces import ModifyWhiteSpaceTransformer
+from preprocess.transform.remove_comments import RemoveCommentsTransformer
+from preprocess.transform.remove_empty_lines import RemoveEmptyLineTransformer
+from preprocess.transform.remove_unassigned_strings import RemoveUnassignedStringTransformer
+from preprocess.transform.remove_unused_imports import RemoveUnusedImportTransformer
+
+
+class CensusVisitor(cst.CSTVisitor):
+    """
+    Counts the nodes of each type, and the 'For:range' loops and 'Expr:SimpleString' statements
+    """
+
+    def __init__(self):
+        self.census = Counter()
+
+    def on_visit(self, node: "CSTNode") -> bool:
+        self.census[type(node).__name__] += 1
+        return super().on_visit(node)
+
+    def visit_For(self, node: "For") -> None:
+        if m.matches(node.iter, m.Call(func=m.Name("range"))):
+            self.census["For:range"] += 1
+
+    def visit_Expr(self, node: "Expr") -> None:
+        if m.matches(node.value, m.SimpleString()):
+            self.census["Expr:SimpleString"] += 1
+
+
+def get_census(node):
+    visitor = CensusVisitor()
+    node.visit(visitor)
+    return visitor.census
+
+
+# for each transformer, whether it can change a module with the given census and args
+# (transformers that are not listed, e.g., the ones modifying new lines and whitespaces, always run)
+APPLICABILITY = {
+    CommaTransformer: lambda census, args: any(census[t] for t in ("Tuple", "List", "Set", "Dict")),
+    ChangeCompToForTransformer: lambda census, args: census[
+        {"list": "ListComp", "set": "SetComp", "dict": "DictComp"}[args[0]]] > 0,
+    ForToWhileTransformer: lambda census, args: census["For:range"] > 0,
+    LambdaToFunctionTransformer: lambda census, args: census["Lambda"] > 0,
+    ChangeLocalVariableNameTransformer: lambda census, args: census["FunctionDef"] > 0,
+    # any simple statement line of a body can be combined or split, not only assignments (e.g., 'print(1); x = 2')
+    CombineStatementsTransformer: lambda census, args: census["SimpleStatementLine"] > 0,
+    RemoveCommentsTransformer: lambda census, args: census["Comment"] + census["Expr:SimpleString"] > 0,
+    RemoveEmptyLineTransformer: lambda census, args: census["EmptyLine"] > 0,
+    RemoveUnassignedStringTransformer: lambda census, args: census["Expr:SimpleString"] > 0,
+    RemoveUnusedImportTransformer: lambda census, args: census["Import"] + census["ImportFrom"] > 0,
+}
+
+
+def is_applicable(census, args):
+    """
+    :param census: get_census of the module
+    :param args: stage (transformer_class, args[, get_metadata])
+    :return: False if the stage certainly makes no changes
+    """
+    transformer_class, transformer_args = args[0], args[1]
+    if transformer_class not in APPLICABILITY:
+        return True
+    return APPLICABILITY[transformer_class](census, transformer_args)
+
+
+# transformers that only modify or remove nodes, so that the census of the module stays an upper bound
+# (AddNewLineTransformer and CommaTransformer add EmptyLine and Comma nodes once the code is parsed again)
+NON_ADDING_TRANSFORMERS = frozenset({
+    ModifyWhiteSpaceTransformer,
+    RemoveCommentsTransformer,
+    RemoveEmptyLineTransformer,
+    ChangeLocalVariableNameTransformer,
+    RemoveUnassignedStringTransformer,
+    RemoveUnusedImportTransformer,
+})
+
+
+def may_add_nodes(args):
+    """
+    Whether the census has to be recomputed after the stage changed the module
+    """
+    return args[0] not in NON_ADDING_TRANSFORMERS
+
+
+def get_empty_logs(args):
+    """
+    Logs of a stage that made no changes
+    """
+    transformer_class, transformer_args = args[0], args[1]
+    # the metadata is not used until the transformer visits a module
+    metadata = (None,) if len(args) > 2 else ()
+    return transformer_class(*metadata, *transformer_args).get_logs()
@@ -102,10 +102,10 @@ def _comp_to_for_loops(target, value, name_generator):
 
 
 class ChangeCompToForTransformer(ModifyAfterExtractionTransformer):
-    def __init__(self, name_generator, comp_type, p=1):
+    def __init__(self, name_generator, comp_type, p=1, rng=None):
         value_types = {"list": [m.ListComp()], "set": [m.SetComp()], "dict": [m.DictComp()]}[comp_type]
         target_types = [m.Name(), m.Attribute()]
-        super().__init__(value_types, target_types, _comp_to_for_loops, name_generator, p=p)
+        super().__init__(value_types, target_types, _comp_to_for_loops, name_generator, p=p, rng=rng)
         self.comp_type = comp_type
 
     def get_logs(self):
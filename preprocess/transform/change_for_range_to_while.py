@@ -14,10 +14,11 @@ from preprocess.transform.utils.create_node import create_assign_statement, crea
 
 class ForToWhileTransformer(cst.CSTTransformer):
 
-    def __init__(self, name_generator, p):
+    def __init__(self, name_generator, p, rng=None):
         # stack for storing the canonical name of the current function
         self.name_generator = name_generator
         self.p = p
+        self.rng = rng if rng is not None else random
         self.num_changes = 0
 
     def get_logs(self):
@@ -27,7 +28,7 @@ class ForToWhileTransformer(cst.CSTTransformer):
             self, original_node: "For", updated_node: "For"
     ) -> Union["BaseStatement", FlattenSentinel["BaseStatement"], RemovalSentinel]:
 
-        if self.p != 1 and random.random() > self.p:
+        if self.p != 1 and self.rng.random() > self.p:
             return updated_node
         if m.matches(updated_node.iter, m.Call()):
             func = updated_node.iter.func
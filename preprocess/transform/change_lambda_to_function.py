@@ -18,8 +18,8 @@ def _lambda_to_function(target, value, name_generator):
 
 
 class LambdaToFunctionTransformer(ModifyAfterExtractionTransformer):
-    def __init__(self, p=1):
-        super().__init__([m.Lambda()], [m.Name()], _lambda_to_function, p=p)
+    def __init__(self, p=1, rng=None):
+        super().__init__([m.Lambda()], [m.Name()], _lambda_to_function, p=p, rng=rng)
 
     def get_logs(self):
         return {"lambda_to_function": self.num_changes}
@@ -3,62 +3,94 @@ Changing local variable names in function definitions when nonlocal is not used
 """
 
 import random
-from typing import Union
+from typing import Optional
 
 import libcst as cst
 import libcst.matchers as m
-from libcst import FlattenSentinel, RemovalSentinel
+from libcst.metadata import ScopeProvider, FunctionScope
 
 from preprocess.transform.utils.new_names import NameGenerator
-from preprocess.transform.utils.transform_node import modify_local_variable_names
 from preprocess.transform.utils.visit import get_local_assigntarget_names, get_param_names, get_non_local_names
 
 
+def _get_name_nodes(scope, name):
+    """
+    Name nodes of all assignments and references of a name in a scope
+    Returns None if any of them is not a Name node (e.g., imports, function definitions, string annotations)
+    """
+    assignments = scope.assignments[name]
+    if not assignments:
+        return None
+
+    name_nodes = set()
+    for assignment in assignments:
+        if not isinstance(assignment, cst.metadata.Assignment) or not m.matches(assignment.node, m.Name()):
+            return None
+        name_nodes.add(assignment.node)
+        for access in assignment.references:
+            if not m.matches(access.node, m.Name()):
+                return None
+            name_nodes.add(access.node)
+    return name_nodes
+
+
 class ChangeLocalVariableNameTransformer(cst.CSTTransformer):
+    METADATA_DEPENDENCIES = (ScopeProvider,)
 
-    def __init__(self, name_generator, p=1):
+    def __init__(self, name_generator, p=1, rng=None):
         # stack for storing the canonical name of the current function
         self.name_generator = name_generator
 
         self.p = p
+        self.rng = rng if rng is not None else random
         self.num_changes = 0
 
+        # new names for the Name nodes to be renamed, collected for each function scope
+        self.updated_names = {}
+
     def get_logs(self):
         return {"change_variable_names": self.num_changes}
 
     def get_updated_name(self, reference):
-        if self.p == 1 or random.random() < self.p:
+        if self.p == 1 or self.rng.random() < self.p:
             updated_name = self.name_generator.new_name()
             self.num_changes += 1
         else:
             updated_name = reference
         return updated_name
 
-    def leave_Name(
-            self, original_node: cst.FunctionDef, updated_node: cst.FunctionDef
-    ) -> cst.CSTNode:
-        return updated_node
+    def visit_FunctionDef(self, node: "FunctionDef") -> Optional[bool]:
+        if not m.matches(node.body, m.IndentedBlock()):
+            return True
 
-    def leave_FunctionDef(
-            self, original_node: "FunctionDef", updated_node: "FunctionDef"
-    ) -> Union["BaseStatement", FlattenSentinel["BaseStatement"], RemovalSentinel]:
+        scope = self.get_metadata(ScopeProvider, node.body, None)
+        if not isinstance(scope, FunctionScope):
+            return True
 
-        if not m.matches(original_node.body, m.IndentedBlock()):
-            return updated_node
+        local_exclude_names = {node.name.value} \
+                              | get_param_names(node.params) \
+                              | get_non_local_names(node)
+        maybe_include_names = get_local_assigntarget_names(node.body)
 
-        local_exclude_names = {updated_node.name.value} \
-                              | get_param_names(updated_node.params) \
-                              | get_non_local_names(updated_node)
-        maybe_include_names = get_local_assigntarget_names(original_node.body)
-
-        updated_names = {}
-        for name in maybe_include_names:
+        # sorted, so that the random choices do not depend on the iteration order of the set
+        for name in sorted(maybe_include_names):
             if name in local_exclude_names:
                 continue
-            updated_names[name] = self.get_updated_name(name)
-
-        updated_node = modify_local_variable_names(updated_node, updated_names)
+            name_nodes = _get_name_nodes(scope, name)
+            if name_nodes is None:
+                continue
+            updated_name = self.get_updated_name(name)
+            if updated_name == name:
+                continue
+            for name_node in name_nodes:
+                self.updated_names[name_node] = updated_name
+        return True
 
+    def leave_Name(
+            self, original_node: "Name", updated_node: "Name"
+    ) -> "BaseExpression":
+        if original_node in self.updated_names:
+            return updated_node.with_changes(value=self.updated_names[original_node])
         return updated_node
 
 
@@ -28,7 +28,7 @@ from libcst import RemovalSentinel, FlattenSentinel, MaybeSentinel
 from libcst._types import CSTNodeT
 
 from preprocess.transform.utils.create_node import create_assign_statement_plural, create_assign_plural
-from preprocess.transform.utils.visit import get_all_names
+from preprocess.transform.utils.visit import get_all_names, NodeSummaryIndex
 from preprocess.transform.utils.visit import has_call, has_same_name, has_yield
 
 
@@ -38,16 +38,20 @@ class CombineStatementsTransformer(cst.CSTTransformer):
     Else split statements
     """
 
-    def __init__(self, split_ratio, p):
+    def __init__(self, split_ratio, p, rng=None):
         # stack for storing the canonical name of the current function
         self.split_ratio = split_ratio
         self.p = p
+        self.rng = rng if rng is not None else random
         self.num_combines = 0
 
         self.targets, self.values, self.target_names = [], [], set()
         self.part, self.num_parts = None, 0
         self.new_body, self.new_body_element = [], []
 
+        # summaries of the subtrees checked by has_* and get_all_names
+        self.index = NodeSummaryIndex()
+
     def get_logs(self):
         return {"combine_statement": self.num_combines}
 
@@ -94,7 +98,7 @@ class CombineStatementsTransformer(cst.CSTTransformer):
             self.part, self.num_parts = None, 0
             for body_element in body:
                 # stop randomly attempt to modify
-                if self.p != 1 and random.random() > self.p:
+                if self.p != 1 and self.rng.random() > self.p:
                     self._append_to_new_body(body_element)
                     continue
 
@@ -123,19 +127,19 @@ class CombineStatementsTransformer(cst.CSTTransformer):
 
                     # stop if any value that will be assigned is in the targets
                     for assign_target in part.targets:
-                        self.target_names = self.target_names.union(get_all_names(assign_target))
-                    if has_same_name(part.value, self.target_names):
+                        self.target_names = self.target_names.union(get_all_names(assign_target, self.index))
+                    if has_same_name(part.value, self.target_names, self.index):
                         self._append_to_new_body_element(part.deep_clone())
                         continue
 
                     # split if any value has keyword "yield"
-                    if has_yield(part):
+                    if has_yield(part, self.index):
                         self._append_to_new_body_element(part.deep_clone())
                         self._append_to_new_body()
                         continue
 
                     # split randomly with a pre-defined ratio
-                    if (self.split_ratio != 1 and random.random() > self.split_ratio):
+                    if (self.split_ratio != 1 and self.rng.random() > self.split_ratio):
                         self._append_to_new_body_element()
 
                     self.num_parts += 1
@@ -166,7 +170,7 @@ class CombineStatementsTransformer(cst.CSTTransformer):
                         self.values += [cst.Element(part.value)] * len(part.targets)
 
                     # split if there was any function call
-                    if has_call(part):
+                    if has_call(part, self.index):
                         self._append_to_new_body_element()
 
                 if self.new_body_element:
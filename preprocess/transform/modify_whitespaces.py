@@ -10,9 +10,10 @@ from libcst import MaybeSentinel
 
 class ModifyWhiteSpaceTransformer(cst.CSTTransformer):
 
-    def __init__(self, mode: Union[bool, str] = True, p=1):
+    def __init__(self, mode: Union[bool, str] = True, p=1, rng=None):
         # stack for storing the canonical name of the current function
         self.p = p
+        self.rng = rng if rng is not None else random
         self.mode = mode
         self.num_changes = 0
 
@@ -28,12 +29,12 @@ class ModifyWhiteSpaceTransformer(cst.CSTTransformer):
     def leave_SimpleWhitespace(
             self, original_node: "SimpleWhitespace", updated_node: "SimpleWhitespace"
     ) -> Union["BaseParenthesizableWhitespace", MaybeSentinel]:
-        if self.p != 1 and random.random() > self.p:
+        if self.p != 1 and self.rng.random() > self.p:
             return updated_node
         if self.mode == True:
             self.num_changes += 1
             return updated_node.with_changes(
-                value=original_node.value + ' '
+                value=updated_node.value + ' '
             )
         elif self.mode == False:
             self.num_changes += 1
@@ -8,15 +8,14 @@ from typing import Union
 import libcst as cst
 import libcst.matchers as m
 from libcst import RemovalSentinel, Comment, FlattenSentinel
-from libcst.metadata import ParentNodeProvider
 
 
 class RemoveCommentsTransformer(cst.CSTTransformer):
-    METADATA_DEPENDENCIES = (ParentNodeProvider,)
 
-    def __init__(self, p):
+    def __init__(self, p, rng=None):
         # stack for storing the canonical name of the current function
         self.p = p
+        self.rng = rng if rng is not None else random
         self.num_changes = 0
 
     def get_logs(self):
@@ -25,7 +24,7 @@ class RemoveCommentsTransformer(cst.CSTTransformer):
     def leave_Comment(
             self, original_node: "Comment", updated_node: "Comment"
     ) -> "Comment":
-        if self.p != 1 and random.random() > self.p:
+        if self.p != 1 and self.rng.random() > self.p:
             return updated_node
         self.num_changes += 1
         return RemovalSentinel(RemovalSentinel.REMOVE)
@@ -35,7 +34,7 @@ class RemoveCommentsTransformer(cst.CSTTransformer):
     ) -> Union[
         "BaseSmallStatement", FlattenSentinel["BaseSmallStatement"], RemovalSentinel
     ]:
-        if self.p != 1 and random.random() > self.p:
+        if self.p != 1 and self.rng.random() > self.p:
             return updated_node
         if m.matches(updated_node.value, m.SimpleString()):
             return RemovalSentinel(RemovalSentinel.REMOVE)
@@ -10,9 +10,10 @@ from libcst import FlattenSentinel, RemovalSentinel
 
 class RemoveEmptyLineTransformer(cst.CSTTransformer):
 
-    def __init__(self, p):
+    def __init__(self, p, rng=None):
         # stack for storing the canonical name of the current function
         self.p = p
+        self.rng = rng if rng is not None else random
         self.num_changes = 0
 
     def get_logs(self):
@@ -22,7 +23,7 @@ class RemoveEmptyLineTransformer(cst.CSTTransformer):
             self, original_node: "EmptyLine", updated_node: "EmptyLine"
     ) -> Union["EmptyLine", FlattenSentinel["EmptyLine"], RemovalSentinel]:
         # remove empty line if no comment
-        if self.p != 1 and random.random() > self.p:
+        if self.p != 1 and self.rng.random() > self.p:
             return updated_node
         if not updated_node.comment:
             self.num_changes += 1
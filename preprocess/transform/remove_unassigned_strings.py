@@ -11,9 +11,10 @@ from libcst import FlattenSentinel, RemovalSentinel
 
 class RemoveUnassignedStringTransformer(cst.CSTTransformer):
 
-    def __init__(self, p):
+    def __init__(self, p, rng=None):
         # stack for storing the canonical name of the current function
         self.p = p
+        self.rng = rng if rng is not None else random
         self.num_changes = 0
 
     def get_logs(self):
@@ -24,7 +25,7 @@ class RemoveUnassignedStringTransformer(cst.CSTTransformer):
     ) -> Union[
         "BaseSmallStatement", FlattenSentinel["BaseSmallStatement"], RemovalSentinel
     ]:
-        if self.p != 1 and random.random() > self.p:
+        if self.p != 1 and self.rng.random() > self.p:
             return updated_node
         if m.matches(updated_node.value, m.SimpleString()):
             return RemovalSentinel(RemovalSentinel.REMOVE)
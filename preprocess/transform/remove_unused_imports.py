@@ -14,10 +14,11 @@ from preprocess.transform.utils.tools import get_unused_imports
 class RemoveUnusedImportTransformer(cst.CSTTransformer):
     def __init__(
             self, unused_imports: Dict[Union[cst.Import, cst.ImportFrom], Set[str]],
-            p
+            p, rng=None
     ) -> None:
         self.unused_imports = unused_imports
         self.p = p
+        self.rng = rng if rng is not None else random
         self.num_changes = 0
 
     def get_logs(self):
@@ -37,7 +38,7 @@ class RemoveUnusedImportTransformer(cst.CSTTransformer):
                 name_value = asname.name.value
             else:
                 name_value = name.name.value
-            if name_value not in self.unused_imports[original_node] or (self.p != 1 and random.random() > self.p):
+            if name_value not in self.unused_imports[original_node] or (self.p != 1 and self.rng.random() > self.p):
                 names_to_keep.append(name.with_changes(comma=cst.MaybeSentinel.DEFAULT))
             else:
                 self.num_changes += 1
@@ -8,20 +8,24 @@ from libcst._types import CSTNodeT
 
 from preprocess.transform.utils.create_node import create_assign_statement_plural, create_assign_statement
 from preprocess.transform.utils.new_names import NameGenerator
-from preprocess.transform.utils.visit import has_call, has_same_name, get_all_names
+from preprocess.transform.utils.visit import has_call, has_same_name, get_all_names, NodeSummaryIndex
 
 
 class ModifyAfterExtractionTransformer(cst.CSTTransformer):
 
-    def __init__(self, value_types=None, target_types=None, modify_func=None, name_generator=None, p=1):
+    def __init__(self, value_types=None, target_types=None, modify_func=None, name_generator=None, p=1, rng=None):
         # stack for storing the canonical name of the current function
         self.p = p
+        self.rng = rng if rng is not None else random
         self.value_types = value_types
         self.target_types = target_types
         self.modify_func = modify_func
         self.name_generator = name_generator
         self.num_changes = 0
 
+        # summaries of the subtrees checked by has_* and get_all_names
+        self.index = NodeSummaryIndex()
+
     def match_value_type(self, value):
         for value_type in self.value_types:
             if m.matches(value, value_type):
@@ -62,18 +66,18 @@ class ModifyAfterExtractionTransformer(cst.CSTTransformer):
                 for element in part.value.elements:
                     if self.match_value_type(element.value):
                         count_type += 1
-                        if has_call(element):
+                        if has_call(element, self.index):
                             count_type_with_call += 1
                     else:
-                        if has_call(element):
+                        if has_call(element, self.index):
                             return -1, -1
             else:
                 if self.match_value_type(part.value):
                     count_type += 1
-                    if has_call(part):
+                    if has_call(part, self.index):
                         count_type_with_call += 1
                 else:
-                    if has_call(part):
+                    if has_call(part, self.index):
                         return -1, -1
         return count_type, count_type_with_call
 
@@ -111,8 +115,8 @@ class ModifyAfterExtractionTransformer(cst.CSTTransformer):
                             # do not split when any value being assigned is in one of the targets
                             target_names = set()
                             for assign_target in part.targets:
-                                target_names = target_names.union(get_all_names(assign_target))
-                            if has_same_name(part.value, target_names):
+                                target_names = target_names.union(get_all_names(assign_target, self.index))
+                            if has_same_name(part.value, target_names, self.index):
                                 new_body.append(cst.SimpleStatementLine(
                                     (part.with_changes(semicolon=MaybeSentinel.DEFAULT)
                                      ,)))
@@ -127,7 +131,7 @@ class ModifyAfterExtractionTransformer(cst.CSTTransformer):
                                 continue
 
                             # randomly do not split with a pre-defined probability
-                            if self.p != 1 and random.random() > self.p:
+                            if self.p != 1 and self.rng.random() > self.p:
                                 new_body.append(cst.SimpleStatementLine(
                                     (part.with_changes(semicolon=MaybeSentinel.DEFAULT)
                                      ,)))
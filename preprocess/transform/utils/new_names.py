@@ -1,23 +1,24 @@
+import builtins
 from keyword import kwlist, softkwlist
 
-import libcst as cst
-
 from preprocess.transform.utils.visit import get_all_names
 
+# keywords, soft keywords and built-in functions, constants, exceptions, etc.
+# (same names as the builtin scope of cst.metadata.GlobalScope)
+# note: 'self' need not preserve its name
+BUILTIN_NAMES = frozenset(kwlist) | frozenset(softkwlist) | frozenset(dir(builtins))
+
 
 class NameGenerator:
     """
     Generates a new name that is not seen in both the source code and the builtin scope
     Can customize new names by modifying the self.new_name method
+    A single generator can be shared by several transformers on the same source code,
+    since every generated name is added to the used names
     """
 
     def __init__(self, source_tree, preserved: set = None, exclude_builtin=True):
         self.exclude_builtin = exclude_builtin
-        # built-in functions, constants, exceptions, global variables, etc
-        self.builtin_scope = cst.metadata.GlobalScope().parent
-
-        # note: 'self' need not preserve its name
-        self.keywords = set(kwlist) | set(softkwlist)
         self.preserved = preserved if preserved else set()
 
         self.used_names = get_all_names(source_tree) if source_tree else set()
@@ -28,7 +29,7 @@ class NameGenerator:
         return name in self.preserved
 
     def is_name_builtin(self, name):
-        return name in self.keywords or self.builtin_scope.__contains__(name)
+        return name in BUILTIN_NAMES
 
     def is_name_used(self, name):
         return name in self.used_names
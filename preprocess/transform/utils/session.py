@@ -0,0 +1,87 @@
+import libcst as cst
+
+from preprocess.transform.utils.budget import StageTimeout
+from preprocess.transform.utils.new_names import NameGenerator
+
+
+class MetadataSession:
+    """
+    Carries a module from one transformer to the next together with its metadata
+    The MetadataWrapper (a deep copy of the module) and the metadata are only built when a transformer needs them,
+    and are kept until a transformer actually changes the module
+    """
+
+    def __init__(self, source_module):
+        self.module = source_module
+        self._wrapper = None
+        self._cache = {}
+        self._name_generators = {}
+
+    @property
+    def wrapper(self):
+        if self._wrapper is None:
+            wrapper = cst.metadata.MetadataWrapper(self.module)
+            # continue with the copy so that the metadata refers to the nodes being transformed
+            # both are set together, so that a stage interrupted while copying leaves the session as it was
+            self._wrapper, self.module = wrapper, wrapper.module
+        return self._wrapper
+
+    def resolve(self, provider):
+        return self.wrapper.resolve(provider)
+
+    def get(self, func, *providers):
+        """
+        Result of func applied to the resolved providers, cached until the module changes
+        """
+        if func not in self._cache:
+            self._cache[func] = func(*[self.resolve(provider) for provider in providers])
+        return self._cache[func]
+
+    def get_name_generator(self, preserved_names):
+        """
+        NameGenerator shared by all transformers of the session
+        Its used names are collected once and kept up to date by the generated names, so it is not invalidated
+        """
+        key = frozenset(preserved_names) if preserved_names else frozenset()
+        if key not in self._name_generators:
+            self._name_generators[key] = NameGenerator(self.module, preserved_names)
+        return self._name_generators[key]
+
+    def invalidate(self):
+        self._wrapper = None
+        self._cache = {}
+
+    def update(self, fixed_module, logs):
+        """
+        Continue with fixed_module unless the transformer reported no changes and left the module as it was
+        """
+        if not any(logs.values()) and fixed_module.deep_equals(self.module):
+            return
+        self.module = fixed_module
+        self.invalidate()
+
+    def transform(self, transformer_class, args, get_metadata=None, rng=None):
+        """
+        Same as transform_module, but reuses the metadata of the session
+        :return: logs of the transformer
+        """
+        kwargs = {'rng': rng} if rng is not None else {}
+        if get_metadata:
+            wrapper, metadata = get_metadata[0](self.module, *get_metadata[1:], session=self)
+            transformer = transformer_class(metadata, *args, **kwargs)
+        else:
+            wrapper = None
+            transformer = transformer_class(*args, **kwargs)
+        if wrapper is None and transformer.get_inherited_dependencies():
+            wrapper = self.wrapper
+
+        try:
+            fixed_module = wrapper.visit(transformer) if wrapper else self.module.visit(transformer)
+        except StageTimeout:
+            raise
+        except Exception as e:
+            raise RuntimeError(f"{transformer_class.__name__} failed") from e
+
+        logs = transformer.get_logs()
+        self.update(fixed_module, logs)
+        return logs
@@ -4,47 +4,74 @@ from typing import Dict, Union, Set
 
 import libcst as cst
 
+from preprocess.transform.utils.budget import StageTimeout
 from preprocess.transform.utils.new_names import NameGenerator
 
 
-def transform(source, transformer_class, args, get_metadata=None, parse_test=False):
+def transform(source, transformer_class, args, get_metadata=None, parse_test=False, rng=None):
+    name = transformer_class.__name__
     try:
         source_module = cst.parse_module(source)
-    except:
-        raise ValueError("Source code could not be parsed")
+    except StageTimeout:
+        raise
+    except Exception as e:
+        raise ValueError(f"{name}: source code could not be parsed") from e
+
+    fixed_module, logs = transform_module(source_module, transformer_class, args, get_metadata, rng)
+    fixed = fixed_module.code
+
+    if parse_test:
+        try:
+            cst.parse_module(fixed)
+        except StageTimeout:
+            raise
+        except Exception as e:
+            raise ValueError(f"{name}: transformed code could not be parsed") from e
+    return fixed, logs
+
+
+def transform_module(source_module, transformer_class, args, get_metadata=None, rng=None):
+    """
+    Same as transform, but takes and returns a parsed cst.Module so that several transformers
+    can be chained without printing and re-parsing the code in between
+    :param rng: random.Random used by the transformer instead of the global random state
+    """
+    kwargs = {'rng': rng} if rng is not None else {}
     if get_metadata:
         wrapper, metadata = get_metadata[0](source_module, *get_metadata[1:])
-        transformer = transformer_class(metadata, *args)
+        transformer = transformer_class(metadata, *args, **kwargs)
     else:
         wrapper = cst.metadata.MetadataWrapper(source_module)
-        transformer = transformer_class(*args)
+        transformer = transformer_class(*args, **kwargs)
 
     try:
-        fixed = wrapper.visit(transformer).code
-    except:
-        print(args)
-        print(source)
-        raise RuntimeError()
-
-    if parse_test:
-        try:
-            cst.parse_module(fixed)
-        except:
-            print(args)
-            print_code_diff(source, fixed, show_diff=True)
-            raise ValueError()
-    return fixed, transformer.get_logs()
+        fixed_module = wrapper.visit(transformer)
+    except StageTimeout:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"{transformer_class.__name__} failed") from e
+    return fixed_module, transformer.get_logs()
 
 
-def get_name_generator(source_module, preserved_names):
+def get_name_generator(source_module, preserved_names, session=None):
+    if session:
+        # the transformer does not depend on any metadata, so no wrapper is needed
+        return None, session.get_name_generator(preserved_names)
     name_generator = NameGenerator(source_module, preserved_names)
     wrapper = cst.metadata.MetadataWrapper(source_module)
     return wrapper, name_generator
 
 
-def get_unused_imports(source_module):
+def get_unused_imports(source_module, session=None):
+    if session:
+        wrapper = session.wrapper
+        return wrapper, session.get(find_unused_imports, cst.metadata.ScopeProvider)
     wrapper = cst.metadata.MetadataWrapper(source_module)
-    scopes = set(wrapper.resolve(cst.metadata.ScopeProvider).values())
+    return wrapper, find_unused_imports(wrapper.resolve(cst.metadata.ScopeProvider))
+
+
+def find_unused_imports(scope_metadata):
+    scopes = set(scope_metadata.values())
     unused_imports: Dict[Union[cst.Import, cst.ImportFrom], Set[str]] = defaultdict(set)
     for scope in scopes:
         for assignment in scope.assignments:
@@ -54,7 +81,7 @@ def get_unused_imports(source_module):
             ):
                 if len(assignment.references) == 0:
                     unused_imports[node].add(assignment.name)
-    return wrapper, unused_imports
+    return unused_imports
 
 
 def get_undefined_references(source):
@@ -1,10 +1,73 @@
-from typing import Optional
+from typing import Optional, NamedTuple, FrozenSet
 
 import libcst as cst
 import libcst.matchers as m
 
 
-def get_all_names(node):
+class NodeSummary(NamedTuple):
+    has_call: bool
+    has_yield: bool
+    has_new_line: bool
+    has_comment: bool
+    names: FrozenSet[str]
+
+
+class NodeSummaryIndex:
+    """
+    Summaries of the subtrees of nodes, used by the has_* and get_all_names functions
+    Each node is summarized once, bottom-up, so repeated queries on overlapping subtrees take O(1)
+    """
+
+    class SummaryVisitor(cst.CSTVisitor):
+        def __init__(self, summaries):
+            self.summaries = summaries
+            # accumulators of the nodes being visited: [has_call, has_yield, has_new_line, has_comment, names]
+            self.stack = [[False, False, False, False, set()]]
+
+        def on_visit(self, node: "CSTNode") -> bool:
+            summary = self.summaries.get(node)
+            if summary is not None:
+                # already summarized: do not visit the children again
+                self.stack.append(summary)
+                return False
+            # isinstance instead of matchers, since this runs for every node
+            self.stack.append([
+                isinstance(node, cst.Call),
+                isinstance(node, cst.Yield),
+                isinstance(node, cst.TrailingWhitespace) and isinstance(node.newline, cst.Newline),
+                isinstance(node, cst.Comment),
+                {node.value} if isinstance(node, cst.Name) else set()
+            ])
+            return True
+
+        def on_leave(self, original_node: "CSTNode") -> None:
+            summary = self.stack.pop()
+            if not isinstance(summary, NodeSummary):
+                summary = NodeSummary(*summary[:4], frozenset(summary[4]))
+                self.summaries[original_node] = summary
+
+            parent = self.stack[-1]
+            for i in range(4):
+                parent[i] = parent[i] or summary[i]
+            parent[4] |= summary.names
+
+    def __init__(self, node=None):
+        self.summaries = {}
+        if node is not None:
+            self.get(node)
+
+    def get(self, node):
+        summary = self.summaries.get(node)
+        if summary is None:
+            node.visit(self.SummaryVisitor(self.summaries))
+            summary = self.summaries[node]
+        return summary
+
+
+def get_all_names(node, index=None):
+    if index is not None:
+        return set(index.get(node).names)
+
     class NameVisitor(cst.CSTVisitor):
         def __init__(self):
             self.names = set()
@@ -18,6 +81,20 @@ def get_all_names(node):
     return visitor.names
 
 
+def count_nodes(node):
+    class CountVisitor(cst.CSTVisitor):
+        def __init__(self):
+            self.count = 0
+
+        def on_visit(self, node: "CSTNode") -> bool:
+            self.count += 1
+            return True
+
+    visitor = CountVisitor()
+    node.visit(visitor)
+    return visitor.count
+
+
 def get_local_assigntarget_names(node):
     class GetLocalAssignTargetNames(cst.CSTVisitor):
         def __init__(self):
@@ -78,7 +155,10 @@ def get_non_local_names(node):
     return visitor.name
 
 
-def has_same_name(node, target_names):
+def has_same_name(node, target_names, index=None):
+    if index is not None:
+        return not index.get(node).names.isdisjoint(target_names)
+
     class HasSameNameVisitor(cst.CSTVisitor):
         def __init__(self, target_names):
             self.has_name = False
@@ -94,7 +174,10 @@ def has_same_name(node, target_names):
     return visitor.has_name
 
 
-def has_call(node):
+def has_call(node, index=None):
+    if index is not None:
+        return index.get(node).has_call
+
     class HasCallVisitor(cst.CSTVisitor):
         def __init__(self):
             self.has_call = False
@@ -108,7 +191,10 @@ def has_call(node):
     return visitor.has_call
 
 
-def has_new_line(node):
+def has_new_line(node, index=None):
+    if index is not None:
+        return index.get(node).has_new_line
+
     class NewLineVisitor(cst.CSTVisitor):
         def __init__(self):
             self.has_new_line = False
@@ -123,7 +209,10 @@ def has_new_line(node):
     return visitor.has_new_line
 
 
-def has_comment(node):
+def has_comment(node, index=None):
+    if index is not None:
+        return index.get(node).has_comment
+
     class CommentVisitor(cst.CSTVisitor):
         def __init__(self):
             self.has_comment = False
@@ -137,7 +226,10 @@ def has_comment(node):
     return visitor.has_comment
 
 
-def has_yield(node):
+def has_yield(node, index=None):
+    if index is not None:
+        return index.get(node).has_yield
+
     class YieldVisitor(cst.CSTVisitor):
         def __init__(self):
             self.has_yield = False
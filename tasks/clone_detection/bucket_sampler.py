@@ -0,0 +1,81 @@
+"""
+Batches of pairs of similar lengths under a token budget, to spend less compute on padding than fixed-size batches
+"""
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def get_pair_lengths(dataset):
+    """
+    max(len(code1), len(code2)) of each pair of a dataset tokenized by pretokenize.py
+    """
+    dataset = dataset.with_format('numpy')
+    return np.maximum(dataset['code1_length'], dataset['code2_length'])
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batch sampler whose batches hold pairs of the same length bucket, with batch size x longest pair <= max_tokens
+    (the padded size of each side of the batch). Each epoch, the pairs are shuffled within their buckets and the
+    batches are shuffled, so the batches are different in every epoch but still padded to at most bucket_width tokens.
+    Pairs longer than max_tokens are put in batches of one.
+    """
+
+    def __init__(self, lengths, max_tokens, bucket_width=16, shuffle=True, seed=0, max_batch_size=None):
+        """
+        :param lengths: length of each pair (e.g., get_pair_lengths)
+        :param max_tokens: token budget of a batch
+        :param bucket_width: width of the length buckets in tokens
+        :param shuffle: shuffle within the buckets and the batches (otherwise, the batches are sorted by length)
+        :param max_batch_size: maximum number of pairs of a batch (default: no limit)
+        """
+        super().__init__()
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.bucket_width = bucket_width
+        self.shuffle = shuffle
+        self.seed = seed
+        self.max_batch_size = max_batch_size
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+
+    def get_batches(self):
+        """
+        Batches of the current epoch (lists of indices)
+        """
+        if self._batches is not None:
+            return self._batches
+
+        rng = np.random.default_rng((self.seed, self.epoch))
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        # stable sort by bucket, so that the pairs of a bucket stay in a random order
+        order = order[np.argsort(self.lengths[order] // self.bucket_width, kind='stable')]
+
+        batches, batch, longest, batch_bucket = [], [], 0, None
+        for index, length in zip(order.tolist(), self.lengths[order].tolist()):
+            bucket = length // self.bucket_width
+            new_longest = max(longest, length)
+            full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (full or bucket != batch_bucket or (len(batch) + 1) * new_longest > self.max_tokens):
+                batches.append(batch)
+                batch, new_longest = [], length
+            batch.append(index)
+            longest, batch_bucket = new_longest, bucket
+        if batch:
+            batches.append(batch)
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        self._batches = batches
+        return batches
+
+    def __iter__(self):
+        yield from self.get_batches()
+
+    def __len__(self):
+        return len(self.get_batches())
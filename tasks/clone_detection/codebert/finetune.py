@@ -1,16 +1,19 @@
 import argparse
 
 import torch
-from transformers import AutoTokenizer, AutoModel
-from datasets import load_dataset_builder, load_dataset, load_from_disk
+from transformers import AutoTokenizer, AutoModel, BatchEncoding
 from torch.utils.data import Dataset, DataLoader
 from tensorboardX import SummaryWriter
 from tqdm import tqdm
 from collections import defaultdict
 import numpy as np
+from functools import partial
 
 import os
 
+from tasks.clone_detection.bucket_sampler import TokenBudgetBatchSampler, get_pair_lengths
+from tasks.clone_detection.pretokenize import add_pretokenize_arguments, load_tokenized
+
 def parse():
     """
     parse arguments
@@ -25,7 +28,11 @@ def parse():
                             No learning rate scheduling if 0 is given
                         """)
     parser.add_argument('--batch_size', '-bs', type=int, default=4,
-                        help="batch size")
+                        help="batch size (if --max_tokens is 0)")
+    parser.add_argument('--max_tokens', '-mt', type=int, default=0,
+                        help="token budget of a batch of pairs of similar lengths instead of a fixed batch size (0: off)")
+    parser.add_argument('--bucket_width', '-bw', type=int, default=16,
+                        help="width of the length buckets in tokens (with --max_tokens)")
     parser.add_argument('--model_name', '-m', type=str, default="microsoft/codebert-base",
                         help="pretrained model name") # "microsoft/codebert-base"
     parser.add_argument('--version_name_prefix', '-v', type=str, default='v',
@@ -34,6 +41,13 @@ def parse():
                         help="base logging directory for tensorboard")
     parser.add_argument('--checkpoint_dir', '-ckpt_dir', type=str, default='ckpt',
                         help="base checkpoint directory") # /mnt/ssd/696ds/checkpoints
+    parser.add_argument('--single_pass', '-sp', action='store_true',
+                        help="encode code1 and code2 in one padded batch with a single encoder call")
+    parser.add_argument('--in_batch_negatives', '-ibn', action='store_true',
+                        help="score all BxB pairs of a batch, the other pairs of the batch being negatives")
+    parser.add_argument('--num_workers', '-nw', type=int, default=0,
+                        help="number of DataLoader workers")
+    add_pretokenize_arguments(parser)
 
     args = parser.parse_args()
     return args
@@ -41,7 +55,13 @@ def parse():
 
 
 class CloneDetector(torch.nn.Module):
-    def __init__(self, model_name, device):
+    def __init__(self, model_name, device, in_batch_negatives=False):
+        """
+        :param in_batch_negatives: in training, score code1 of each pair against code2 of every pair of the batch
+            (B x B scores from one matrix multiply, the pairs of the batch on the diagonal); the off-diagonal pairs are
+            negatives, except those of the same clone group (see get_same_group). In evaluation, only the pairs of the
+            batch are scored.
+        """
         super().__init__()
         self.model = AutoModel.from_pretrained(model_name)
         self.linear = torch.nn.Linear(768, 768)
@@ -49,48 +69,110 @@ class CloneDetector(torch.nn.Module):
         self.sigmoid = torch.nn.Sigmoid()
         self.bce_loss = torch.nn.BCELoss()
         self.device = device
+        self.in_batch_negatives = in_batch_negatives
 
-    def forward(self, batch):
-        code1, code2 = batch['code1'].to(self.device), batch['code2'].to(self.device)
+    def encode(self, code):
+        out = self.model(**code).last_hidden_state[:, 0, :] # CLS vector (shape: (B, 768, ))
 
-        out1 = self.model(**code1).last_hidden_state[:, 0, :] # CLS vector (shape: (B, 768, ))
-        out2 = self.model(**code2).last_hidden_state[:, 0, :]
+        # out = self.dropout(out) # (shape: (B, 768, ))
 
-        # out1 = self.dropout(out1) # (shape: (B, 768, ))
-        # out2 = self.dropout(out2)
+        return self.linear(out) # (shape: (B, 768, ))
+
+    def forward(self, batch):
+        if 'codes' in batch:
+            # code1 and code2 of all pairs in one batch (see collate_fn with single_pass)
+            out1, out2 = self.encode(batch['codes'].to(self.device)).chunk(2)
+        else:
+            out1 = self.encode(batch['code1'].to(self.device))
+            out2 = self.encode(batch['code2'].to(self.device))
 
-        out1 = self.linear(out1) # (shape: (B, 768, ))
-        out2 = self.linear(out2)
+        if self.in_batch_negatives and self.training:
+            return out1 @ out2.T / 10 # (shape: (B, B, ))
 
         scores = torch.sum(out1 * out2, dim=1) / 10
 
         return scores
 
-    def loss(self, scores, labels):
+    def loss(self, scores, labels, same_group=None):
+        """
+        :param same_group: for B x B scores, mask of the other pairs that are not negatives (see get_same_group)
+        """
         probs = self.sigmoid(scores.type(torch.float32))
 
+        if probs.dim() == 2:
+            # the pairs of the batch on the diagonal weigh as much as the other pairs, which are negatives
+            off_diagonal = ~torch.eye(len(probs), dtype=torch.bool, device=probs.device)
+            if same_group is not None:
+                off_diagonal &= ~same_group.to(probs.device)
+            loss = self.bce_loss(torch.diagonal(probs), labels)
+            if off_diagonal.any():
+                loss = (loss + self.bce_loss(probs[off_diagonal], torch.zeros_like(probs[off_diagonal]))) / 2
+            return loss
+
         loss = self.bce_loss(probs, labels)
 
         return loss
 
     def acc(self, scores, labels, threshold=0):
+        if scores.dim() == 2:
+            scores = torch.diagonal(scores)
         return torch.mean(((scores > threshold).type(torch.int32) == labels).type(torch.float32))
 
-def tokenize(code):
-    return tokenizer(code, return_tensors="pt", truncation=True, padding="longest", max_length=512)
-
-def collate_fn(items):
+def pad(sequences, pad_token_id):
+    """
+    Pad pre-tokenized ids to the longest sequence of the batch
+    """
+    input_ids = torch.full((len(sequences), max(len(ids) for ids in sequences)), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    for i, ids in enumerate(sequences):
+        input_ids[i, :len(ids)] = torch.as_tensor(ids, dtype=torch.long)
+        attention_mask[i, :len(ids)] = 1
+    return BatchEncoding({'input_ids': input_ids, 'attention_mask': attention_mask})
+
+def get_same_group(code1, code2, labels):
+    """
+    Mask of the (code1 of pair i, code2 of pair j) combinations of a batch that are clones: the codes are identical or
+    in the same group, the groups being linked by identical codes and similar pairs of the batch
+    :param code1, code2: token ids of the codes of each pair
+    :param labels: 1 for the similar pairs
+    :return: B x B bool tensor
+    """
+    parent = {}
+
+    def find(code):
+        while parent.setdefault(code, code) != code:
+            parent[code] = parent[parent[code]]
+            code = parent[code]
+        return code
+
+    code1, code2 = [tuple(ids) for ids in code1], [tuple(ids) for ids in code2]
+    for ids1, ids2, label in zip(code1, code2, labels):
+        if label:
+            parent[find(ids1)] = find(ids2)
+    groups1, groups2 = [find(ids) for ids in code1], [find(ids) for ids in code2]
+    return torch.tensor([[group1 == group2 for group2 in groups2] for group1 in groups1], dtype=torch.bool)
+
+def collate_fn(items, pad_token_id, single_pass=False, same_group=False):
+    """
+    :param single_pass: pad code1 and code2 of all pairs together as 'codes' (code1 first), for one encoder call
+    :param same_group: add the 'same_group' mask of get_same_group (for in-batch negatives)
+    """
     x = {}
 
     code1, code2, labels = [], [], []
     for item in items:
-        code1.append(item['code1'])
-        code2.append(item['code2'])
+        code1.append(item['code1_input_ids'])
+        code2.append(item['code2_input_ids'])
         labels.append(item['similar'])
 
-    x['code1'] = tokenize(code1)
-    x['code2'] = tokenize(code2)
+    if single_pass:
+        x['codes'] = pad(code1 + code2, pad_token_id)
+    else:
+        x['code1'] = pad(code1, pad_token_id)
+        x['code2'] = pad(code2, pad_token_id)
     x['labels'] = torch.tensor(labels, dtype=torch.float32)
+    if same_group:
+        x['same_group'] = get_same_group(code1, code2, labels)
 
     return x
 
@@ -116,26 +198,42 @@ def linear_learning_rate_scheduler(optimizer, steps, target, warm_up, decay):
 if __name__ == '__main__':
     args = parse()
 
-    version_name = args.version_name_prefix + f"_{args.model_name.split('/')[-1]}_lr{args.lr:.1e}" + (f"-w{args.warmup}" if args.warmup else "")
+    version_name = args.version_name_prefix + f"_{args.model_name.split('/')[-1]}_lr{args.lr:.1e}" + (f"-w{args.warmup}" if args.warmup else "") \
+                   + ("-ibn" if args.in_batch_negatives else "")
     print(version_name)
 
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
     print(device)
 
-    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
-
-    PoolC_dataset_dir = os.path.join(os.path.abspath(os.path.join(os.getcwd(), os.pardir)), 'data', 'PoolC_train')
-    train_dataset = load_dataset("PoolC/1-fold-clone-detection-600k-5fold", split="train")
-    val_dataset = load_dataset("PoolC/1-fold-clone-detection-600k-5fold", split="val")
-    train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=collate_fn)
-    val_dataloader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=collate_fn)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name, use_fast=True)
+
+    # tokenized once and loaded from the cache afterwards (see pretokenize.py)
+    train_dataset = load_tokenized(args.model_name, 'train', args.dataset_name, args.data_files, args.load_from_disk,
+                                   args.max_length, args.tokenized_cache, args.num_proc, tokenizer)
+    val_dataset = load_tokenized(args.model_name, 'val', args.dataset_name, None, args.load_from_disk,
+                                 args.max_length, args.tokenized_cache, args.num_proc, tokenizer)
+    collate = partial(collate_fn, pad_token_id=tokenizer.pad_token_id, single_pass=args.single_pass,
+                      same_group=args.in_batch_negatives)
+    if args.max_tokens:
+        train_sampler = TokenBudgetBatchSampler(get_pair_lengths(train_dataset), args.max_tokens, args.bucket_width)
+        val_sampler = TokenBudgetBatchSampler(get_pair_lengths(val_dataset), args.max_tokens, args.bucket_width,
+                                              shuffle=False)
+        train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=collate,
+                                      num_workers=args.num_workers)
+        val_dataloader = DataLoader(val_dataset, batch_sampler=val_sampler, collate_fn=collate,
+                                    num_workers=args.num_workers)
+    else:
+        train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=collate,
+                                      num_workers=args.num_workers)
+        val_dataloader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, collate_fn=collate,
+                                    num_workers=args.num_workers)
 
     os.makedirs(args.log_dir, exist_ok=True)
     writer = SummaryWriter(os.path.join(args.log_dir, version_name))
     checkpoint_dir = os.path.join(args.checkpoint_dir, version_name)
     os.makedirs(checkpoint_dir, exist_ok=True)
 
-    model = CloneDetector(args.model_name, device).to(device)
+    model = CloneDetector(args.model_name, device, args.in_batch_negatives).to(device)
     optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=0.01)
     model.train(True)
     pbar = tqdm(train_dataloader)
@@ -148,7 +246,7 @@ if __name__ == '__main__':
 
         labels = batch['labels'].to(device)
         scores = model(batch)
-        loss = model.loss(scores, labels)
+        loss = model.loss(scores, labels, batch.get('same_group'))
         acc = model.acc(scores, labels)
 
         loss.backward()
@@ -0,0 +1,165 @@
+"""
+(anchor, positive, negatives) triples of the augmented datasets written by preprocess.generate with --format arrow
+The Arrow IPC files are memory-mapped, so the codes are only read when an item is served, and the DataLoader
+workers share the pages of the files instead of holding copies of the dataset.
+"""
+import os
+import glob
+import argparse
+
+import numpy as np
+import pyarrow as pa
+from torch.utils.data import Dataset
+
+
+def get_arrow_paths(path):
+    """
+    :param path: .arrow file, or directory of .arrow shards
+    """
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(os.path.join(path, '*.arrow')))
+    else:
+        paths = [path]
+    if not paths or not all(p.endswith('.arrow') for p in paths):
+        raise ValueError(f"No Arrow IPC file in {path} (generate the dataset with --format arrow)")
+    return paths
+
+
+def open_table(paths):
+    """
+    Memory-mapped table of the Arrow IPC files, whose chunks are the record batches of the files
+    """
+    return pa.concat_tables([pa.ipc.open_file(pa.memory_map(path, 'r')).read_all() for path in paths])
+
+
+def get_index_prefix(path):
+    return os.path.join(path, 'pairs') if os.path.isdir(path) else path + '.pairs'
+
+
+def build_pairing_index(table, min_rows=2):
+    """
+    Group the rows by sample, the original code (aug_index -1) first and then its augmentations
+    The groups are stored in the compressed sparse row format: the rows of the i-th group are
+    rows[offsets[i]:offsets[i + 1]].
+    :param min_rows: groups with fewer rows (samples without augmentations) are dropped
+    :return: offsets, rows
+    """
+    sample_ids = table.column('sample_id').to_numpy()
+    aug_indices = table.column('aug_index').to_numpy()
+    order = np.lexsort((aug_indices, sample_ids))
+    _, starts, counts = np.unique(sample_ids[order], return_index=True, return_counts=True)
+    keep = counts >= min_rows
+    starts, counts = starts[keep], counts[keep]
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    rows = order[(np.repeat(starts - offsets[:-1], counts) + np.arange(offsets[-1]))].astype(np.int64)
+    return offsets, rows
+
+
+def load_pairing_index(path, table, min_rows=2):
+    """
+    Pairing index of the dataset at path, built once and saved next to the data as <prefix>.offsets.npy and
+    <prefix>.rows.npy, which are memory-mapped
+    The index is built again when a data file is newer than the index.
+    """
+    prefix = get_index_prefix(path)
+    offsets_path, rows_path = prefix + '.offsets.npy', prefix + '.rows.npy'
+    data_mtime = max(os.path.getmtime(p) for p in get_arrow_paths(path))
+    if not (os.path.exists(rows_path) and os.path.getmtime(rows_path) >= data_mtime):
+        offsets, rows = build_pairing_index(table, min_rows)
+        # rows is saved last, so that an interrupted build is not used
+        for array, array_path in ((offsets, offsets_path), (rows, rows_path)):
+            with open(array_path + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.replace(array_path + '.tmp', array_path)
+    return np.load(offsets_path, mmap_mode='r'), np.load(rows_path, mmap_mode='r')
+
+
+class ContrastiveTripleDataset(Dataset):
+    """
+    Item i is the original code of the i-th sample (anchor), one of its augmentations (positive) and codes of
+    num_negatives other samples (negatives)
+    The positive and the negatives are drawn with a generator seeded by (seed, epoch, i), so an item is the same in
+    every worker and changes with set_epoch.
+    """
+
+    def __init__(self, path, code_column='code', num_negatives=1, seed=0, min_rows=2):
+        """
+        :param path: .arrow file, or directory of .arrow shards
+        :param code_column: 'code' for CodeSearchNet, 'code1' or 'code2' for PoolC
+        :param num_negatives: number of negatives of each item
+        :param min_rows: samples with fewer codes (including the original) are not used
+        """
+        self.path = path
+        self.code_column = code_column
+        self.num_negatives = num_negatives
+        self.seed = seed
+        self.min_rows = min_rows
+        self.epoch = 0
+        self._open()
+        if len(self) < num_negatives + 1:
+            raise ValueError(f"{len(self)} samples are not enough for {num_negatives} negatives")
+
+    def _open(self):
+        table = open_table(get_arrow_paths(self.path))
+        self.offsets, self.rows = load_pairing_index(self.path, table, self.min_rows)
+        self.chunks = table.column(self.code_column).chunks
+        self.chunk_starts = np.cumsum([0] + [len(chunk) for chunk in self.chunks])
+
+    def __getstate__(self):
+        # the files are mapped again in the process that unpickles the dataset (e.g., spawned workers)
+        state = self.__dict__.copy()
+        for key in ('offsets', 'rows', 'chunks', 'chunk_starts'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_code(self, row):
+        chunk_index = np.searchsorted(self.chunk_starts, row, side='right') - 1
+        return self.chunks[chunk_index][row - self.chunk_starts[chunk_index]].as_py()
+
+    def get_random_code(self, sample, rng, start=0):
+        begin, end = self.offsets[sample], self.offsets[sample + 1]
+        return self.get_code(self.rows[rng.integers(begin + start, end)])
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        rng = np.random.default_rng((self.seed, self.epoch, index))
+        # other samples, drawn without replacement from the samples except index
+        negatives = rng.choice(len(self) - 1, self.num_negatives, replace=False)
+        negatives[negatives >= index] += 1
+        return {
+            'anchor': self.get_code(self.rows[self.offsets[index]]),
+            'positive': self.get_random_code(index, rng, start=1),
+            'negatives': [self.get_random_code(sample, rng) for sample in negatives],
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', type=str,
+                        help='.arrow file or directory of .arrow shards written by preprocess.generate')
+    parser.add_argument('--code_column', '-c', type=str, default='code',
+                        help="'code' for CodeSearchNet, 'code1' or 'code2' for PoolC")
+    parser.add_argument('--num_negatives', '-k', type=int, default=1,
+                        help='number of negatives of each item')
+    args = parser.parse_args()
+
+    dataset = ContrastiveTripleDataset(args.path, args.code_column, args.num_negatives)
+    print(f'{len(dataset)} samples')
+    item = dataset[0]
+    print('anchor:', item['anchor'], sep='\n')
+    print('positive:', item['positive'], sep='\n')
+    for negative in item['negatives']:
+        print('negative:', negative, sep='\n')
@@ -1,37 +1,82 @@
 import numpy as np
 
+METRICS = ('acc', 'f1', 'precision', 'recall')
 
-def find_threshold(scores, labels, metric='acc'):
-    # metric: 'acc' or 'f1'
+
+def get_metrics(tp, fp, fn, tn):
+    """
+    :param tp, fp, fn, tn: arrays of the numbers of true/false positives/negatives
+    :return: dict of arrays: 'tp', 'fp', 'fn', 'tn', 'acc', 'precision', 'recall', 'f1' (0 where undefined)
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(tp + fp > 0, tp / (tp + fp), 0.0)
+        recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+        f1 = np.where(tp > 0, 2 * tp / (2 * tp + fp + fn), 0.0)
+    return {
+        'tp': tp,
+        'fp': fp,
+        'fn': fn,
+        'tn': tn,
+        'acc': (tp + tn) / (tp + fp + fn + tn),
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+    }
 
 
-    for label in labels:
-        assert abs(label - 1) < 1e-10 or abs(label) < 1e-10
-    assert metric in ['acc', 'f1']
+def get_threshold_curves(scores, labels):
+    """
+    Metrics of the predictions (score > threshold) at every cut point between distinct sorted scores
+    :param scores: scores of the pairs
+    :param labels: 0 or 1 for each pair
+    :return: dict of arrays of the same length: 'threshold', 'tp', 'fp', 'fn', 'tn', 'acc', 'precision', 'recall', 'f1'
+    """
+    scores = np.asarray(scores, dtype=np.float64).ravel()
+    labels = np.asarray(labels).ravel()
+    if len(scores) != len(labels) or len(scores) == 0:
+        raise ValueError(f"Expected the same non-zero number of scores and labels, got {len(scores)} and {len(labels)}")
+    if not np.all((labels == 0) | (labels == 1)):
+        raise ValueError("Labels should be 0 or 1")
 
-    arr = sorted(list(zip(scores, labels)), key=lambda x: x[0])
+    order = np.argsort(scores, kind='stable')
+    scores, labels = scores[order], labels[order].astype(np.int64)
+    n = len(scores)
 
-    pre = 0.0
-    post = sum(labels)
+    # cut i: the first i sorted pairs are predicted negative, the others positive
+    # pairs with the same score are on the same side, so only the cuts between distinct scores are kept
+    cuts = np.concatenate([[0], np.flatnonzero(scores[1:] > scores[:-1]) + 1, [n]])
+    fn = np.concatenate([[0], np.cumsum(labels)])[cuts]
+    tn = cuts - fn
+    tp = fn[-1] - fn
+    fp = (n - cuts) - tp
 
-    max_eval, best_threshold = 0.0, arr[0][0]
-    for i in range(len(arr) - 1):
-        pre += arr[i][1]
-        post -= arr[i][1]
+    # midpoints between the scores around the cuts, or the lower score if the midpoint rounds up to the higher one
+    inner = cuts[1:-1]
+    midpoints = (scores[inner - 1] + scores[inner]) / 2
+    threshold = np.concatenate([
+        [np.nextafter(scores[0], -np.inf)],
+        np.where(midpoints < scores[inner], midpoints, scores[inner - 1]),
+        [scores[-1]],
+    ])
 
-        tp = post
-        fp = len(arr) - i - post
-        fn = pre
-        tn = (i-pre)
+    return dict(threshold=threshold, **get_metrics(tp, fp, fn, tn))
 
-        acc = (tp + tn) / len(arr)
-        precision = tp / (tp + fp)
-        recall = tp / (tp + fn)
-        f1 = 2 * precision * recall / (precision + recall)
 
-        eval = {'acc': acc, 'f1': f1}
+def find_thresholds(scores, labels, metrics=METRICS):
+    """
+    Best threshold for each metric
+    :return: {metric: (threshold, value)}, curves of get_threshold_curves
+    """
+    curves = get_threshold_curves(scores, labels)
+    best = {}
+    for metric in metrics:
+        i = int(np.argmax(curves[metric]))
+        best[metric] = (float(curves['threshold'][i]), float(curves[metric][i]))
+    return best, curves
 
-        if max_eval < eval[metric]:
-            max_eval = acc
-            best_threshold = (arr[i][0] + arr[i][1]) / 2
-    return best_threshold
\ No newline at end of file
+
+def find_threshold(scores, labels, metric='acc'):
+    # metric: 'acc', 'f1', 'precision' or 'recall'
+    assert metric in METRICS
+    best, _ = find_thresholds(scores, labels, [metric])
+    return best[metric][0]
@@ -0,0 +1,123 @@
+"""
+Tokenize the code pairs of PoolC or of the augmented datasets once, and cache the token ids in Arrow files
+The cache of a dataset is keyed by the tokenizer name and max_length, so training only pads the cached ids.
+"""
+import os
+import re
+import shutil
+import hashlib
+import argparse
+
+from datasets import load_dataset, load_from_disk
+from transformers import AutoTokenizer
+
+CODE_COLUMNS = ('code1', 'code2')
+
+
+def slugify(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_')
+
+
+def get_data_files_key(data_files):
+    """
+    Key of local data files (e.g., the parquet or arrow files of preprocess.generate), which changes when the files
+    are regenerated
+    """
+    sha256 = hashlib.sha256()
+    for path in sorted(os.path.abspath(path) for path in data_files):
+        stat = os.stat(path)
+        sha256.update(f'{path}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode('utf-8'))
+    return 'files-' + sha256.hexdigest()[:16]
+
+
+def get_cache_path(cache_dir, dataset_key, split, tokenizer_name, max_length):
+    return os.path.join(cache_dir, slugify(dataset_key), split, f'{slugify(tokenizer_name)}-{max_length}')
+
+
+def load_pairs(dataset_name=None, split='train', data_files=None, load_from_disk_path=False):
+    """
+    :param dataset_name: name of a dataset on the hub (or a path saved with save_to_disk if load_from_disk_path)
+    :param data_files: parquet or arrow files of preprocess.generate.PoolC, used instead of dataset_name
+    """
+    if data_files:
+        builder = 'parquet' if data_files[0].endswith('.parquet') else 'arrow'
+        return load_dataset(builder, data_files=list(data_files), split='train')
+    if load_from_disk_path:
+        return load_from_disk(dataset_name)[split]
+    return load_dataset(dataset_name, split=split)
+
+
+def tokenize_pairs(dataset, tokenizer, max_length=512, num_proc=None, batch_size=1000):
+    """
+    Replace the code columns with '<code>_input_ids' and '<code>_length' columns
+    The ids are truncated to max_length but not padded.
+    """
+    code_columns = [column for column in CODE_COLUMNS if column in dataset.column_names]
+
+    def tokenize_batch(batch):
+        tokenized = {}
+        for column in code_columns:
+            input_ids = tokenizer(batch[column], truncation=True, max_length=max_length)['input_ids']
+            tokenized[column + '_input_ids'] = input_ids
+            tokenized[column + '_length'] = [len(ids) for ids in input_ids]
+        return tokenized
+
+    return dataset.map(tokenize_batch, batched=True, batch_size=batch_size, num_proc=num_proc,
+                       remove_columns=code_columns, desc='tokenize')
+
+
+def load_tokenized(tokenizer_name, split='train', dataset_name=None, data_files=None, load_from_disk_path=False,
+                   max_length=512, cache_dir='tokenized', num_proc=None, tokenizer=None):
+    """
+    Tokenized dataset from the cache, tokenized and saved to the cache if it is not there
+    :param tokenizer: tokenizer of tokenizer_name, loaded if not given
+    :return: datasets.Dataset with '<code>_input_ids' and '<code>_length' columns and the other columns (e.g., labels)
+    """
+    dataset_key = get_data_files_key(data_files) if data_files else dataset_name
+    cache_path = get_cache_path(cache_dir, dataset_key, split, tokenizer_name, max_length)
+    if os.path.exists(cache_path):
+        return load_from_disk(cache_path)
+
+    if tokenizer is None:
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
+    if not tokenizer.is_fast:
+        print(f'Warning: {tokenizer_name} has no fast tokenizer, tokenization will be slow')
+    dataset = tokenize_pairs(load_pairs(dataset_name, split, data_files, load_from_disk_path), tokenizer,
+                             max_length, num_proc)
+
+    # saved to a temporary directory first, so that an interrupted run does not leave an incomplete cache
+    temp_path = cache_path + '.tmp'
+    shutil.rmtree(temp_path, ignore_errors=True)
+    dataset.save_to_disk(temp_path)
+    os.replace(temp_path, cache_path)
+    print(f'Saved: {cache_path}')
+    return load_from_disk(cache_path)
+
+
+def add_pretokenize_arguments(parser):
+    parser.add_argument('--dataset_name', '-name', type=str, default="PoolC/1-fold-clone-detection-600k-5fold",
+                        help='dataset name or path')
+    parser.add_argument('--load_from_disk', '-ld', action='store_true')
+    parser.add_argument('--data_files', '-df', action='append', default=None,
+                        help='parquet or arrow files of augmented pairs to use instead of the dataset (train split)')
+    parser.add_argument('--max_length', '-ml', type=int, default=512,
+                        help='maximum number of tokens of a code')
+    parser.add_argument('--tokenized_cache', '-tc', type=str, default='tokenized',
+                        help='directory of the tokenized datasets')
+    parser.add_argument('--num_proc', type=int, default=None,
+                        help='number of processes of datasets.map')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_name', '-m', type=str, default="microsoft/codebert-base",
+                        help="pretrained model name whose tokenizer is used")
+    parser.add_argument('--split', '-s', action='append', default=None,
+                        help='splits to tokenize (default: train and val)')
+    add_pretokenize_arguments(parser)
+    args = parser.parse_args()
+
+    for split in args.split or ['train', 'val']:
+        dataset = load_tokenized(args.model_name, split, args.dataset_name, args.data_files, args.load_from_disk,
+                                 args.max_length, args.tokenized_cache, args.num_proc)
+        print(split, dataset)
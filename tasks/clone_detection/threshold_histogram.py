@@ -0,0 +1,153 @@
+"""
+Mergeable histogram of clone-detection scores, to find thresholds over pairs scored by several processes or machines
+Each shard updates its own ThresholdHistogram, the histograms are merged (or saved and merged later), and the best
+thresholds are read off the bin edges. Memory is O(num_bins) instead of O(number of pairs).
+"""
+import json
+import argparse
+
+import numpy as np
+
+from tasks.clone_detection.find_threshold import get_metrics
+
+
+class ThresholdHistogram:
+    """
+    Numbers of positive and negative pairs in num_bins equal bins of [low, high]
+    Bin 0 has the scores <= low, bin i the scores in (edges[i - 1], edges[i]] and bin num_bins + 1 the scores > high,
+    so that the predictions (score > threshold) at every edge are counted exactly.
+    """
+
+    def __init__(self, low=-10.0, high=10.0, num_bins=10000):
+        """
+        :param low, high: range of the thresholds, which should cover the scores where the best thresholds may be
+        :param num_bins: number of bins between low and high
+        """
+        if not low < high or num_bins < 1:
+            raise ValueError(f"Invalid bins: low={low}, high={high}, num_bins={num_bins}")
+        self.low = float(low)
+        self.high = float(high)
+        self.num_bins = int(num_bins)
+        self.edges = np.linspace(self.low, self.high, self.num_bins + 1)
+        self.positives = np.zeros(self.num_bins + 2, dtype=np.int64)
+        self.negatives = np.zeros(self.num_bins + 2, dtype=np.int64)
+
+    def update(self, scores, labels):
+        """
+        :param scores: scores of the pairs
+        :param labels: 0 or 1 for each pair
+        """
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        labels = np.asarray(labels).ravel()
+        if len(scores) != len(labels):
+            raise ValueError(f"Expected the same number of scores and labels, got {len(scores)} and {len(labels)}")
+        if not np.all((labels == 0) | (labels == 1)):
+            raise ValueError("Labels should be 0 or 1")
+        bins = np.searchsorted(self.edges, scores, side='left')
+        self.positives += np.bincount(bins[labels == 1], minlength=self.num_bins + 2)
+        self.negatives += np.bincount(bins[labels == 0], minlength=self.num_bins + 2)
+        return self
+
+    def merge(self, other):
+        """
+        Add the counts of another histogram with the same bins
+        """
+        if (self.low, self.high, self.num_bins) != (other.low, other.high, other.num_bins):
+            raise ValueError(f"Cannot merge histograms with different bins: {(self.low, self.high, self.num_bins)} "
+                             f"and {(other.low, other.high, other.num_bins)}")
+        self.positives += other.positives
+        self.negatives += other.negatives
+        return self
+
+    def __len__(self):
+        return int(self.positives.sum() + self.negatives.sum())
+
+    def get_curves(self):
+        """
+        Metrics of the predictions at each edge, and upper bounds of accuracy and F1 at any threshold inside each bin
+        For a threshold in (edges[i], edges[i + 1]], tp and fp are at most those of edges[i] and at least those of
+        edges[i + 1], and tn is at most that of edges[i + 1], which gives 'acc_upper' and 'f1_upper' (num_bins values).
+        :return: dict of arrays, see find_threshold.get_metrics
+        """
+        if len(self) == 0:
+            raise ValueError("Empty histogram")
+        fn = np.cumsum(self.positives)[:-1]
+        tn = np.cumsum(self.negatives)[:-1]
+        tp = self.positives.sum() - fn
+        fp = self.negatives.sum() - tn
+        curves = dict(threshold=self.edges, **get_metrics(tp, fp, fn, tn))
+        num_positives = tp[0] + fn[0]
+        curves['acc_upper'] = (tp[:-1] + tn[1:]) / len(self)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            curves['f1_upper'] = np.where(tp[:-1] > 0, 2 * tp[:-1] / (num_positives + tp[1:] + fp[1:]), 0.0)
+        return curves
+
+    def find_thresholds(self, metrics=('acc', 'f1')):
+        """
+        Best edge for each metric
+        The error bound is the difference between the upper bound of the metric at any threshold in [low, high] and
+        the value at the best edge; the value itself is exact.
+        :param metrics: metrics of find_threshold.get_metrics
+        :return: {metric: (threshold, value, error bound or None)}, curves
+        """
+        curves = self.get_curves()
+        best = {}
+        for metric in metrics:
+            i = int(np.argmax(curves[metric]))
+            value = float(curves[metric][i])
+            error = None
+            if metric + '_upper' in curves:
+                error = max(float(curves[metric + '_upper'].max()) - value, 0.0)
+            best[metric] = (float(curves['threshold'][i]), value, error)
+        return best, curves
+
+    def to_dict(self):
+        return {
+            'low': self.low,
+            'high': self.high,
+            'num_bins': self.num_bins,
+            'positives': self.positives.tolist(),
+            'negatives': self.negatives.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        histogram = cls(state['low'], state['high'], state['num_bins'])
+        histogram.positives = np.asarray(state['positives'], dtype=np.int64)
+        histogram.negatives = np.asarray(state['negatives'], dtype=np.int64)
+        return histogram
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(json.dumps(self.to_dict()))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            return cls.from_dict(json.load(f))
+
+
+def merge_histograms(histograms):
+    merged = None
+    for histogram in histograms:
+        if merged is None:
+            merged = ThresholdHistogram(histogram.low, histogram.high, histogram.num_bins)
+        merged.merge(histogram)
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+',
+                        help='json files of the histograms of the shards (ThresholdHistogram.save)')
+    parser.add_argument('--metric', '-m', action='append', default=None,
+                        help="metric to optimize: 'acc', 'f1', 'precision' or 'recall' (default: acc and f1)")
+    args = parser.parse_args()
+
+    histogram = merge_histograms(ThresholdHistogram.load(path) for path in args.paths)
+    best, _ = histogram.find_thresholds(args.metric or ('acc', 'f1'))
+    print(f'{len(histogram)} pairs')
+    for metric, (threshold, value, error) in best.items():
+        print(f"{metric}: {value:.6f} at threshold {threshold:.6f}"
+              + (f" (at most {error:.6f} below the best threshold in [{histogram.low}, {histogram.high}])"
+                 if error is not None else ''))